@@ -0,0 +1,86 @@
+﻿import os
+import json
+import random
+import argparse
+import itertools
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_DATA_DIR = os.path.join(REPO_DIR, "data")
+
+AUTHORS = ["THU HIẾN", "HOÀI PHƯƠNG", "NGUYÊN KHÔI", "ĐỨC KHUÊ", "MINH ĐỨC", "HỒNG QUANG", "AN VI", "THANH TÙNG"]
+CATEGORIES = ["Thể thao", "Sức khỏe", "Văn hóa", "Thời sự", "Khoa học", "Nhịp sống trẻ", "Bạn đọc làm báo"]
+# Newest synthetic article, fixed so every run produces the same corpus
+END_DATE = datetime(2024, 10, 30, 23, 59)
+
+
+def load_vocabulary(seed_dir=SEED_DATA_DIR):
+    # Real Vietnamese words from the sample articles, most frequent first
+    counts = {}
+    for file_name in sorted(os.listdir(seed_dir)):
+        if file_name.endswith(".json"):
+            with open(os.path.join(seed_dir, file_name), "r", encoding="utf-8") as f:
+                text = json.load(f).get("content", "")
+            for word in text.split():
+                counts[word] = counts.get(word, 0) + 1
+    return sorted(counts, key=lambda word: (-counts[word], word))
+
+
+class ArticleGenerator:
+    def __init__(self, vocabulary, seed=42, zipf_exponent=1.0):
+        self.rng = random.Random(seed)
+        self.vocabulary = vocabulary
+        # Zipf-like word frequencies, like natural text
+        self.cumulative_weights = list(itertools.accumulate(
+            1 / (rank + 1) ** zipf_exponent for rank in range(len(vocabulary))
+        ))
+
+    def words(self, count):
+        return self.rng.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=count)
+
+    def sentence(self):
+        words = self.words(self.rng.randint(8, 25))
+        return " ".join(words).capitalize() + "."
+
+    def article(self, number):
+        date = END_DATE - timedelta(minutes=self.rng.randint(0, 365 * 24 * 60))
+        paragraphs = [
+            " ".join(self.sentence() for _ in range(self.rng.randint(2, 6)))
+            for _ in range(self.rng.randint(3, 10))
+        ]
+        return {
+            # Same shape as the crawled ids: timestamp followed by a running number
+            "post_id": f"{date:%Y%m%d%H%M}{number:07d}",
+            "title": " ".join(self.words(self.rng.randint(6, 14))).capitalize(),
+            "content": "\n".join(paragraphs),
+            "author": self.rng.choice(AUTHORS),
+            "date": f"{date:%d/%m/%Y %H:%M} GMT+7",
+            "category": self.rng.choice(CATEGORIES),
+        }
+
+
+def generate_corpus(output_dir, count, seed=42, seed_dir=SEED_DATA_DIR):
+    os.makedirs(output_dir, exist_ok=True)
+    generator = ArticleGenerator(load_vocabulary(seed_dir), seed)
+
+    for number in range(count):
+        article = generator.article(number)
+        with open(os.path.join(output_dir, f"{article['post_id']}.json"), "w", encoding="utf-8") as f:
+            json.dump(article, f, ensure_ascii=False, indent=4)
+        if (number + 1) % 10000 == 0:
+            print(f"{number + 1}/{count} articles written")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic articles in the data/*.json schema.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--size", default="10k", help="number of articles, e.g. 10k, 100k or 1m")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    size = args.size.lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(size[-1], 1)
+    count = int(size.rstrip("km")) * multiplier
+
+    generate_corpus(args.output_dir, count, args.seed)
+    print(f"Generated {count} articles in '{args.output_dir}'.")
@@ -0,0 +1,64 @@
+﻿import os
+import sys
+import shutil
+import timeit
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import indexing
+import instrumentation
+from run_benchmarks import make_query_mix, run_queries
+
+
+def main(corpus_dir, query_count=200, top_k=10, rounds=5):
+    work_dir = tempfile.mkdtemp(prefix="search_instrumentation_")
+    try:
+        # No result cache, every query runs all of its stages
+        engine = indexing.SearchIndex(corpus_dir, os.path.join(work_dir, "inverted_index"), cache_size=0)
+        engine.warm_up(background=False)
+        _, idf, _ = engine.vectors()
+        mix = make_query_mix(engine.inverted_index, idf, query_count)
+        # Last week of the corpus, so the date filter runs too
+        end = engine.date_index["timestamps"][-1]
+        start = end - 7 * 86400
+
+        # Cost of one disabled stage() and count() call, the only price paid when instrumentation is off
+        calls = 1000000
+        stage_ns = timeit.timeit(lambda: instrumentation.stage("x").__enter__(), number=calls) / calls * 1e9
+        count_ns = timeit.timeit(lambda: instrumentation.count("x"), number=calls) / calls * 1e9
+        print(f"Disabled stage(): {stage_ns:.0f} ns, count(): {count_ns:.0f} ns (including the lambda call)")
+
+        # Off and on alternate, the best round of each is compared to keep noise out
+        print(f"{query_count} queries per mode, top {top_k}, best of {rounds} rounds")
+        for mode, queries in mix.items():
+            best = {False: None, True: None}
+            for _ in range(rounds):
+                for enabled in (False, True):
+                    instrumentation.configure(enabled)
+                    summary = run_queries(queries, lambda query: engine.cached_search(query, top_k, start, end, mode))
+                    if best[enabled] is None or summary["mean_ms"] < best[enabled]["mean_ms"]:
+                        best[enabled] = summary
+            instrumentation.configure(False)
+            off, on = best[False]["mean_ms"], best[True]["mean_ms"]
+            print(f"{mode:>8}: off {off:.3f} ms/query, on {on:.3f} ms/query ({(on / off - 1) * 100:+.1f}%)")
+
+        # Where the time of the instrumented runs went
+        snapshot = instrumentation.metrics.snapshot()
+        for name, stage in snapshot["stages"].items():
+            print(f"{name:>20}: {stage['count']:6d} calls, {stage['mean_ms']:.3f} ms mean, {stage['max_ms']:.3f} ms max")
+        for name, value in snapshot["counters"].items():
+            print(f"{name:>20}: {value}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query latency with instrumentation off and on.")
+    parser.add_argument("corpus_dir", help="folder of article JSON files, see generate_corpus.py")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    main(args.corpus_dir, args.queries, args.top_k, args.rounds)
@@ -0,0 +1,119 @@
+﻿import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from run_benchmarks import percentile
+
+
+def make_requests(words, count, top_k, seed=42):
+    # Same kind of traffic the desktop app sends: mostly keyword searches, some phrases
+    # and boolean queries, a few restricted to a time range
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            query = " ".join(rng.sample(words, rng.randint(1, 3)))
+        elif kind < 0.8:
+            query = '"' + " ".join(rng.sample(words, 2)) + '"'
+        else:
+            query = f"{rng.choice(words)} AND {rng.choice(words)}"
+        request = {"query": query, "top_k": top_k}
+        if rng.random() < 0.1:
+            request["time_range"] = rng.choice(["Last week", "Last month", "Last year"])
+        requests.append(request)
+    return requests
+
+
+async def send(reader, writer, host, request):
+    body = json.dumps(request, ensure_ascii=False).encode("utf-8")
+    writer.write(
+        (f"POST /search HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+         f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body
+    )
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def client(host, port, requests, latencies, statuses):
+    # One keep-alive connection sending its requests back to back
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            try:
+                status = await send(reader, writer, host, request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                statuses["error"] = statuses.get("error", 0) + 1
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run(host, port, requests, concurrency):
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, requests[number::concurrency], latencies, statuses)
+        for number in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, statuses
+
+
+def load_words(data_dir, count=300):
+    # Frequent words of the sample articles, so most searches have results
+    counts = {}
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.endswith(".json"):
+            with open(os.path.join(data_dir, file_name), "r", encoding="utf-8") as f:
+                for word in json.load(f).get("content", "").lower().split():
+                    if word.isalnum() and word not in ("and", "or", "not"):
+                        counts[word] = counts.get(word, 0) + 1
+    return sorted(counts, key=lambda word: (-counts[word], word))[:count]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--data-dir", default=os.path.join(BASE_DIR, "data"), help="articles to take query words from")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32, help="simultaneous keep-alive connections")
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    requests = make_requests(load_words(args.data_dir), args.requests, args.top_k)
+    elapsed, latencies, statuses = asyncio.run(run(args.host, args.port, requests, args.concurrency))
+
+    print(f"{len(requests)} requests over {args.concurrency} connections in {elapsed:.2f} s")
+    print(f"Throughput: {len(requests) / elapsed:.1f} requests/s")
+    if latencies:
+        print(f"Latency: p50 {percentile(latencies, 0.50) * 1000:.2f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print("Responses: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
@@ -0,0 +1,56 @@
+﻿import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import indexing
+import compact_index
+
+
+def measure(build):
+    # Bytes still allocated by build()'s result, and the time it took
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main(corpus_dir):
+    inverted_index = indexing.build_inverted_index(corpus_dir)
+    tokens = inverted_index["tokens"]
+    doc_ids = list(inverted_index["metadata"])
+    postings = sum(len(docs) for docs in tokens.values())
+    positions = sum(len(doc_positions) for docs in tokens.values() for doc_positions in docs.values())
+    print(f"{len(doc_ids)} documents, {len(tokens)} terms, {postings} postings, {positions} positions")
+
+    # Copy of the nested dicts, measured the same way as the compact build. The copy shares
+    # the int objects of the original, so the dict figure is on the low side
+    _, dict_size, _ = measure(lambda: {
+        term: {doc_id: list(doc_positions) for doc_id, doc_positions in docs.items()}
+        for term, docs in tokens.items()
+    })
+    compact, compact_size, compact_time = measure(lambda: compact_index.CompactPostings.from_tokens(tokens, doc_ids))
+
+    print(f"{'dict postings':>16}: {dict_size / 2 ** 20:8.1f} MB, {dict_size / postings:6.1f} bytes/posting")
+    print(f"{'compact postings':>16}: {compact_size / 2 ** 20:8.1f} MB, {compact_size / postings:6.1f} bytes/posting "
+          f"(built in {compact_time:.2f} s)")
+    print(f"Reduction: {dict_size / compact_size:.1f}x")
+
+    compact_inverted_index = dict(inverted_index, tokens=compact)
+    for name, index in (("dict", inverted_index), ("compact", compact_inverted_index)):
+        start = time.perf_counter()
+        indexing.compute_tfidf_vector_space(index)
+        print(f"{'compute_tfidf ' + name:>24}: {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory of dict postings against compact posting lists.")
+    parser.add_argument("corpus_dir", help="folder of article JSON files, see generate_corpus.py")
+    args = parser.parse_args()
+    main(args.corpus_dir)
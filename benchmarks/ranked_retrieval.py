@@ -0,0 +1,62 @@
+﻿import os
+import sys
+import time
+import random
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import indexing
+
+
+def make_queries(idf, count, seed=42):
+    # Mix of frequent terms (long postings) and random vocabulary, like real news queries
+    rng = random.Random(seed)
+    terms = sorted(idf)
+    common = sorted(terms, key=lambda term: idf[term])[:100]
+    queries = []
+    for _ in range(count):
+        words = rng.sample(common, rng.randint(1, 3)) + rng.sample(terms, rng.randint(0, 2))
+        queries.append(" ".join(words))
+    return queries
+
+
+def run(query_vectors, retrieve):
+    start = time.perf_counter()
+    results = [retrieve(query_vector) for query_vector in query_vectors]
+    return time.perf_counter() - start, results
+
+
+def main(engine, query_count=500, top_k=10):
+    index = engine.inverted_index
+    vectors, idf, upper_bounds = engine.vectors()
+
+    query_vectors = [indexing.query_to_vector(query, idf) for query in make_queries(idf, query_count)]
+
+    modes = {
+        "exhaustive": lambda qv: indexing.retrieve_documents(qv, vectors, None, top_k),
+        "term-at-a-time": lambda qv: indexing.retrieve_documents(qv, vectors, index, top_k),
+        "maxscore": lambda qv: indexing.retrieve_documents(qv, vectors, index, top_k, upper_bounds),
+    }
+
+    baseline = None
+    print(f"{len(query_vectors)} queries, top {top_k}, {len(index['metadata'])} documents")
+    for name, retrieve in modes.items():
+        elapsed, results = run(query_vectors, retrieve)
+        if baseline is None:
+            baseline = results
+        identical = "identical" if results == baseline else "DIFFERENT RESULTS"
+        print(f"{name:>15}: {elapsed * 1000 / len(query_vectors):.3f} ms/query ({identical})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare exhaustive, term-at-a-time and MaxScore ranking.")
+    parser.add_argument("--data-dir", default=os.path.join(BASE_DIR, "data"))
+    parser.add_argument("--index-dir", default=os.path.join(BASE_DIR, "inverted_index"))
+    parser.add_argument("--index-file", default=os.path.join(BASE_DIR, "inverted_index.json"))
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    main(indexing.SearchIndex(args.data_dir, args.index_dir, args.index_file), args.queries, args.top_k)
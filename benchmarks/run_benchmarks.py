@@ -0,0 +1,217 @@
+﻿import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import indexing
+import binary_index
+import impact_index
+
+# Slowdowns above this ratio are reported as regressions by --compare
+REGRESSION_THRESHOLD = 1.10
+
+
+def peak_rss_mb():
+    # Peak RSS of the whole process so far, so a stage shows the largest footprint up to its end
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def peak_memory_mb():
+    # Peak traced allocation of the stage alone, only while --memory is tracing
+    if not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+
+
+def timed(function):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+    }
+
+
+def make_query_mix(index, idf, count, seed=7):
+    # Fixed mix for a given corpus: ranked keyword queries, phrases cut out of real
+    # documents and boolean queries over mid-frequency terms
+    rng = random.Random(seed)
+    # Plain words only, so no term can be mistaken for a boolean operator
+    words = [term for term in idf if term.isalnum() and term not in ("and", "or", "not")]
+    terms = sorted(words, key=lambda term: (idf[term], term))
+    frequent = terms[:200]
+    medium = terms[len(terms) // 10:len(terms) // 10 + 2000] or terms
+
+    ranked = [" ".join(rng.sample(frequent, 1) + rng.sample(medium, rng.randint(1, 2))) for _ in range(count)]
+
+    doc_ids = list(index["metadata"])
+    phrases = []
+    while len(phrases) < count:
+        words = [word for word in indexing.tokenize(indexing.get_article_content(index, rng.choice(doc_ids))) if word]
+        if len(words) > 3:
+            start = rng.randrange(len(words) - 3)
+            phrases.append(" ".join(words[start:start + rng.randint(2, 3)]))
+
+    templates = ["{0} AND {1}", "{0} OR {1}", "{0} AND NOT {1}", "({0} OR {1}) AND {2}"]
+    boolean = [
+        rng.choice(templates).format(*rng.sample(frequent, 3))
+        for _ in range(count)
+    ]
+    return {"ranked": ranked, "phrase": phrases, "boolean": boolean}
+
+
+def run_queries(queries, search):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def run(corpus_dir, query_count=200, top_k=10, workers=None, memory=False):
+    work_dir = tempfile.mkdtemp(prefix="search_benchmark_")
+    index_file = os.path.join(work_dir, "inverted_index.json")
+    index_dir = os.path.join(work_dir, "inverted_index")
+    results = {
+        "corpus": os.path.abspath(corpus_dir),
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "query_count": query_count,
+        "top_k": top_k,
+        "timings_s": {},
+        "peak_rss_mb": {},
+        "queries": {},
+    }
+
+    def record(name, seconds):
+        results["timings_s"][name] = seconds
+        results["peak_rss_mb"][name] = peak_rss_mb()
+        if memory:
+            results.setdefault("peak_memory_mb", {})[name] = peak_memory_mb()
+        print(f"{name:>24}: {seconds:.3f} s")
+
+    if memory:
+        # Tracing slows every stage down, so timings from a --memory run are not comparable
+        tracemalloc.start()
+    try:
+        seconds, json_index = timed(lambda: indexing.create_inverted_index(corpus_dir, index_file, workers))
+        record("build_json_index", seconds)
+        results["documents"] = len(json_index["metadata"])
+        del json_index
+
+        seconds, _ = timed(lambda: indexing.create_inverted_index(corpus_dir, index_file))
+        record("load_json_index", seconds)
+
+        seconds, _ = timed(lambda: binary_index.import_json_index(index_file, index_dir))
+        record("write_binary_index", seconds)
+
+        seconds, index = timed(lambda: binary_index.load_binary_index(index_dir))
+        record("load_binary_index", seconds)
+
+        seconds, (vectors, idf) = timed(lambda: indexing.compute_tfidf_vector_space(index))
+        record("compute_tfidf", seconds)
+
+        upper_bounds = indexing.compute_term_upper_bounds(index, idf)
+        mix = make_query_mix(index, idf, query_count)
+
+        seconds, _ = timed(lambda: impact_index.write_impacts(index_dir, "bm25"))
+        record("write_impacts_bm25", seconds)
+        seconds, scorer = timed(lambda: impact_index.ImpactScorer.open(index_dir, index, "bm25"))
+        record("load_impacts_bm25", seconds)
+
+        searches = {
+            "retrieve_documents": (mix["ranked"], lambda query: indexing.retrieve_documents(
+                indexing.query_to_vector(query, idf), vectors, index, top_k)),
+            "retrieve_documents_maxscore": (mix["ranked"], lambda query: indexing.retrieve_documents(
+                indexing.query_to_vector(query, idf), vectors, index, top_k, upper_bounds)),
+            "impact_bm25": (mix["ranked"], lambda query: scorer.search(query, top_k)),
+            "exact_match": (mix["phrase"], lambda query: indexing.exact_match(query, index)),
+            "process_logical_operator": (mix["boolean"], lambda query: indexing.process_logical_operator(query, index)),
+        }
+        for name, (queries, search) in searches.items():
+            results["queries"][name] = run_queries(queries, search)
+            summary = results["queries"][name]
+            print(f"{name:>28}: p50 {summary['p50_ms']:.3f} ms, p99 {summary['p99_ms']:.3f} ms")
+        results["peak_rss_mb"]["total"] = peak_rss_mb()
+    finally:
+        if memory:
+            tracemalloc.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline):
+    # Every timing and latency is compared with the baseline run, higher is worse
+    regressions = []
+    metrics = [("timings_s", name, None) for name in results["timings_s"]]
+    metrics += [("queries", name, key) for name in results["queries"] for key in ("p50_ms", "p99_ms")]
+
+    for section, name, key in metrics:
+        current = results[section][name] if key is None else results[section][name][key]
+        previous = baseline.get(section, {}).get(name)
+        if previous is None:
+            continue
+        previous = previous if key is None else previous.get(key)
+        if not previous:
+            continue
+        ratio = current / previous
+        label = name if key is None else f"{name} {key}"
+        print(f"{label:>40}: {previous:.4f} -> {current:.4f} ({ratio:.2f}x)")
+        if ratio > REGRESSION_THRESHOLD:
+            regressions.append(label)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark index build, load and query latency.")
+    parser.add_argument("corpus_dir", help="folder of article JSON files, see generate_corpus.py")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results file to check for regressions")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory", action="store_true", help="also trace allocations for per-stage peak memory")
+    args = parser.parse_args()
+
+    results = run(args.corpus_dir, args.queries, args.top_k, args.workers, args.memory)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    print(f"Results saved to '{args.output}'.")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
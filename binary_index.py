@@ -0,0 +1,348 @@
+﻿import os
+import sys
+import json
+import mmap
+import shutil
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import doc_store
+import compact_index
+import variant_index
+
+MAGIC = b"SEIX"
+VERSION = 2
+# Version 1 stored positions as plain uint32 arrays, version 2 as delta-encoded varints
+SUPPORTED_VERSIONS = (1, 2)
+
+# magic, format version, term count, document count
+HEADER = struct.Struct("<4sIII")
+# term offset, term length, document frequency, postings offset, positions offset, max term frequency
+ENTRY = struct.Struct("<QIIQQI")
+
+LEXICON_FILE = "lexicon.bin"
+TERMS_FILE = "terms.bin"
+POSTINGS_FILE = "postings.bin"
+POSITIONS_FILE = "positions.bin"
+DOCS_FILE = "docs.json"
+
+
+def _to_bytes(values):
+    data = array("I", values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _from_bytes(buffer, offset, count):
+    data = array("I")
+    data.frombytes(buffer[offset:offset + 4 * count])
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data
+
+
+def encode_positions(positions):
+    # Gaps between sorted positions as LEB128 varints, small gaps take a single byte
+    encoded = bytearray()
+    previous = 0
+    for position in positions:
+        value = position - previous
+        previous = position
+        while value >= 0x80:
+            encoded.append((value & 0x7F) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_positions(buffer, offset, count):
+    positions = []
+    position = 0
+    for _ in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buffer[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        position += value
+        positions.append(position)
+    return positions, offset
+
+
+def _map_file(index_dir, file_name):
+    with open(os.path.join(index_dir, file_name), "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_binary_index(inverted_index, index_dir, compress=True):
+    tokens = inverted_index["tokens"]
+    metadata = inverted_index["metadata"]
+    # Article bodies come from the metadata of a freshly built index or from the document
+    # store of a loaded one
+    documents = inverted_index.get("documents")
+    doc_ids = list(metadata)
+    doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+    terms = sorted(tokens)
+    doc_frequencies = []
+
+    # Write next to the destination first so a crash never leaves a half-written index behind
+    tmp_dir = index_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    with open(os.path.join(tmp_dir, LEXICON_FILE), "wb") as lexicon_out, \
+            open(os.path.join(tmp_dir, TERMS_FILE), "wb") as terms_out, \
+            open(os.path.join(tmp_dir, POSTINGS_FILE), "wb") as postings_out, \
+            open(os.path.join(tmp_dir, POSITIONS_FILE), "wb") as positions_out:
+        lexicon_out.write(HEADER.pack(MAGIC, VERSION, len(terms), len(doc_ids)))
+
+        for term in terms:
+            docs = tokens[term]
+            encoded_term = term.encode("utf-8")
+            postings = []
+            positions = bytearray()
+            max_tf = 0
+
+            for doc_id in sorted(docs, key=doc_numbers.__getitem__):
+                doc_positions = docs[doc_id]
+                postings.extend((doc_numbers[doc_id], len(doc_positions)))
+                positions += encode_positions(doc_positions)
+                max_tf = max(max_tf, len(doc_positions))
+
+            lexicon_out.write(ENTRY.pack(
+                terms_out.tell(), len(encoded_term), len(docs),
+                postings_out.tell(), positions_out.tell(), max_tf
+            ))
+            terms_out.write(encoded_term)
+            postings_out.write(_to_bytes(postings))
+            positions_out.write(positions)
+            doc_frequencies.append((term, len(docs)))
+
+    # Bodies go to the document store, only the compact metadata columns stay in docs.json
+    with doc_store.DocumentStoreWriter(tmp_dir, compress) as writer:
+        for doc_id in doc_ids:
+            if documents is not None:
+                writer.add(documents[doc_id])
+            else:
+                writer.add(metadata[doc_id].get("content", ""))
+
+    columns = doc_store.MetadataColumns.from_metadata(metadata)
+    with open(os.path.join(tmp_dir, DOCS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"doc_ids": doc_ids, "columns": columns.columns}, f, ensure_ascii=False)
+
+    # Accent-folded forms and typo neighbourhoods of the vocabulary
+    variant_index.write_variant_index(tmp_dir, doc_frequencies)
+
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+
+
+class PostingsDictionary(Mapping):
+    # Read-only view of the "tokens" part of an index, backed by memory-mapped segment files.
+    # A term's postings are only decoded when a query looks the term up, into a compact
+    # PostingList. The most recently used cache_terms lists are kept since the same hot
+    # terms come back in most phrase and boolean queries.
+
+    def __init__(self, index_dir, doc_ids, cache_terms=256, doc_numbers=None):
+        self.doc_ids = doc_ids
+        self.table = compact_index.DocTable(doc_ids, doc_numbers)
+        self.cache_terms = cache_terms
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.lexicon = _map_file(index_dir, LEXICON_FILE)
+        self.terms = _map_file(index_dir, TERMS_FILE)
+        self.postings = _map_file(index_dir, POSTINGS_FILE)
+        self.positions = _map_file(index_dir, POSITIONS_FILE)
+
+        magic, self.version, self.term_count, _ = HEADER.unpack_from(self.lexicon, 0)
+        if magic != MAGIC or self.version not in SUPPORTED_VERSIONS:
+            raise ValueError(f"'{index_dir}' is not a supported binary index")
+
+    def _entry(self, number):
+        return ENTRY.unpack_from(self.lexicon, HEADER.size + number * ENTRY.size)
+
+    def _term(self, entry):
+        return self.terms[entry[0]:entry[0] + entry[1]].decode("utf-8")
+
+    def _find(self, term):
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            middle_term = self._term(entry)
+            if middle_term == term:
+                return entry
+            if middle_term < term:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _decode(self, entry):
+        _, _, df, postings_offset, positions_offset, _ = entry
+        postings = _from_bytes(self.postings, postings_offset, 2 * df)
+        frequencies = postings[1::2]
+        offsets = array("I", [0])
+        for tf in frequencies:
+            offsets.append(offsets[-1] + tf)
+
+        if self.version == 1:
+            positions = _from_bytes(self.positions, positions_offset, offsets[-1])
+        else:
+            positions = array("I")
+            offset = positions_offset
+            for tf in frequencies:
+                doc_positions, offset = decode_positions(self.positions, offset, tf)
+                positions.extend(doc_positions)
+        return compact_index.PostingList(self.table, postings[0::2], offsets, positions)
+
+    def __getitem__(self, term):
+        with self._cache_lock:
+            docs = self._cache.get(term)
+            if docs is not None:
+                self._cache.move_to_end(term)
+                self.cache_hits += 1
+                return docs
+
+        entry = self._find(term)
+        if entry is None:
+            raise KeyError(term)
+        docs = self._decode(entry)
+
+        with self._cache_lock:
+            self.cache_misses += 1
+            if self.cache_terms > 0:
+                self._cache[term] = docs
+                if len(self._cache) > self.cache_terms:
+                    self._cache.popitem(last=False)
+        return docs
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def __iter__(self):
+        for number in range(self.term_count):
+            yield self._term(self._entry(number))
+
+    def __len__(self):
+        return self.term_count
+
+    def items(self):
+        for number in range(self.term_count):
+            entry = self._entry(number)
+            yield self._term(entry), self._decode(entry)
+
+    def document_frequencies(self):
+        for number in range(self.term_count):
+            entry = self._entry(number)
+            yield self._term(entry), entry[2]
+
+    def document_frequency(self, term):
+        entry = self._find(term)
+        return entry[2] if entry else 0
+
+    def term_at(self, number):
+        # The lexicon is sorted by term, term_dictionary binary searches it through these
+        return self._term(self._entry(number))
+
+    def document_frequency_at(self, number):
+        return self._entry(number)[2]
+
+    def max_term_frequency(self, term):
+        entry = self._find(term)
+        return entry[5] if entry else 0
+
+    def posting_numbers(self, term):
+        # (number of the term's first posting, doc numbers) without decoding any positions
+        entry = self._find(term)
+        if entry is None:
+            return 0, array("I")
+        postings = _from_bytes(self.postings, entry[3], 2 * entry[2])
+        return entry[3] // 8, postings[0::2]
+
+    def term_postings(self):
+        # (term, doc numbers, term frequencies) of every term in lexicon order, the same
+        # order the postings file is laid out in
+        for number in range(self.term_count):
+            entry = self._entry(number)
+            postings = _from_bytes(self.postings, entry[3], 2 * entry[2])
+            yield self._term(entry), postings[0::2], postings[1::2]
+
+    def cache_stats(self):
+        return {"entries": len(self._cache), "hits": self.cache_hits, "misses": self.cache_misses}
+
+
+def load_binary_index(index_dir):
+    with open(os.path.join(index_dir, DOCS_FILE), "r", encoding="utf-8") as f:
+        docs = json.load(f)
+
+    doc_ids = docs["doc_ids"]
+    if "metadata" in docs:
+        # Indexes written before the document store kept the bodies inside the metadata
+        return {
+            "tokens": PostingsDictionary(index_dir, doc_ids),
+            "metadata": docs["metadata"],
+            "documents": {doc_id: article.get("content", "") for doc_id, article in docs["metadata"].items()},
+        }
+
+    metadata = doc_store.MetadataColumns(doc_ids, docs["columns"])
+    return {
+        "tokens": PostingsDictionary(index_dir, doc_ids, doc_numbers=metadata.doc_numbers),
+        "metadata": metadata,
+        "documents": doc_store.DocumentStore(index_dir, metadata.doc_numbers),
+    }
+
+
+def import_json_index(index_file, index_dir):
+    with open(index_file, "r", encoding="utf-8") as f:
+        inverted_index = json.load(f)
+    write_binary_index(inverted_index, index_dir)
+
+
+def export_json_index(index_dir, index_file):
+    inverted_index = load_binary_index(index_dir)
+    documents = inverted_index["documents"]
+    metadata = {}
+    for doc_id, article in inverted_index["metadata"].items():
+        article = dict(article)
+        article["content"] = documents[doc_id]
+        # Same field order as create_inverted_index writes
+        metadata[doc_id] = {name: article[name] for name in ("title", "content") if name in article}
+        metadata[doc_id].update(article)
+
+    with open(index_file, "w", encoding="utf-8") as f:
+        json.dump({
+            "tokens": {
+                term: {doc_id: list(positions) for doc_id, positions in docs.items()}
+                for term, docs in inverted_index["tokens"].items()
+            },
+            "metadata": metadata,
+        }, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    # python binary_index.py import inverted_index.json inverted_index
+    # python binary_index.py export inverted_index inverted_index.json
+    if len(sys.argv) != 4 or sys.argv[1] not in ("import", "export"):
+        print("Usage: python binary_index.py import <index_file> <index_dir>")
+        print("       python binary_index.py export <index_dir> <index_file>")
+        sys.exit(1)
+
+    if sys.argv[1] == "import":
+        import_json_index(sys.argv[2], sys.argv[3])
+    else:
+        export_json_index(sys.argv[2], sys.argv[3])
@@ -0,0 +1,348 @@
+﻿import re
+from array import array
+
+import phrase
+import variant_index
+import term_dictionary
+
+CONTAINER_BITS = 16
+CONTAINER_SIZE = 1 << CONTAINER_BITS
+# Containers holding more values than this switch from a sorted array to a bitset
+ARRAY_LIMIT = 4096
+
+
+def _array_to_bits(values):
+    bits = bytearray(CONTAINER_SIZE // 8)
+    for value in values:
+        bits[value >> 3] |= 1 << (value & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _bits_to_array(bits):
+    values = array("H")
+    data = bits.to_bytes(CONTAINER_SIZE // 8, "little")
+    for byte_number, byte in enumerate(data):
+        if byte:
+            base = byte_number << 3
+            for bit in range(8):
+                if byte >> bit & 1:
+                    values.append(base + bit)
+    return values
+
+
+def _normalize(container):
+    if isinstance(container, int):
+        if container.bit_count() <= ARRAY_LIMIT:
+            return _bits_to_array(container)
+        return container
+    if len(container) > ARRAY_LIMIT:
+        return _array_to_bits(container)
+    return container
+
+
+def _cardinality(container):
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _and(first, second):
+    if isinstance(first, int) and isinstance(second, int):
+        return first & second
+    if isinstance(first, int):
+        first, second = second, first
+    if isinstance(second, int):
+        return array("H", (value for value in first if second >> value & 1))
+    members = set(second)
+    return array("H", (value for value in first if value in members))
+
+
+def _or(first, second):
+    if isinstance(first, int) or isinstance(second, int) or len(first) + len(second) > ARRAY_LIMIT:
+        first = first if isinstance(first, int) else _array_to_bits(first)
+        second = second if isinstance(second, int) else _array_to_bits(second)
+        return first | second
+    return array("H", sorted(set(first) | set(second)))
+
+
+def _and_not(first, second):
+    if isinstance(first, int):
+        second = second if isinstance(second, int) else _array_to_bits(second)
+        return first & ~second
+    if isinstance(second, int):
+        return array("H", (value for value in first if not second >> value & 1))
+    members = set(second)
+    return array("H", (value for value in first if value not in members))
+
+
+class Bitmap:
+    # Roaring-style compressed doc id set: ids are split by their high 16 bits into
+    # containers that are either a sorted array('H') (sparse) or a 65536-bit int (dense).
+
+    __slots__ = ("containers",)
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+    @classmethod
+    def from_ids(cls, doc_numbers):
+        grouped = {}
+        for number in sorted(doc_numbers):
+            grouped.setdefault(number >> CONTAINER_BITS, array("H")).append(number & (CONTAINER_SIZE - 1))
+        return cls({key: _normalize(values) for key, values in grouped.items()})
+
+    @classmethod
+    def full(cls, count):
+        containers = {}
+        for key in range(0, -(-count // CONTAINER_SIZE)):
+            size = min(CONTAINER_SIZE, count - key * CONTAINER_SIZE)
+            containers[key] = _normalize((1 << size) - 1)
+        return cls(containers)
+
+    def _combine(self, other, operation, keys):
+        containers = {}
+        for key in keys:
+            container = _normalize(operation(self.containers[key], other.containers[key]))
+            if _cardinality(container):
+                containers[key] = container
+        return containers
+
+    def __and__(self, other):
+        keys = self.containers.keys() & other.containers.keys()
+        return Bitmap(self._combine(other, _and, keys))
+
+    def __or__(self, other):
+        keys = self.containers.keys() & other.containers.keys()
+        containers = self._combine(other, _or, keys)
+        for source in (self, other):
+            for key, container in source.containers.items():
+                containers.setdefault(key, container)
+        return Bitmap(containers)
+
+    def __sub__(self, other):
+        keys = self.containers.keys() & other.containers.keys()
+        containers = self._combine(other, _and_not, keys)
+        for key, container in self.containers.items():
+            if key not in other.containers:
+                containers[key] = container
+        return Bitmap(containers)
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            values = _bits_to_array(container) if isinstance(container, int) else container
+            base = key << CONTAINER_BITS
+            for value in values:
+                yield base + value
+
+    def __contains__(self, number):
+        container = self.containers.get(number >> CONTAINER_BITS)
+        if container is None:
+            return False
+        value = number & (CONTAINER_SIZE - 1)
+        if isinstance(container, int):
+            return bool(container >> value & 1)
+        return value in container
+
+
+OPERATORS = ("and", "or", "not")
+TOKEN_PATTERN = re.compile(r'"[^"]*"(?:~\d+)?|\(|\)|[^\s()"]+')
+
+
+def tokenize_query(query):
+    return TOKEN_PATTERN.findall(query)
+
+
+def parse_query(query, expand=None):
+    # Grammar, lowest precedence first (adjacent words form a phrase, like before):
+    #   or_expr  := and_expr ("OR" and_expr)*
+    #   and_expr := not_expr (["AND"] not_expr)*
+    #   not_expr := "NOT" not_expr | primary
+    #   primary  := "(" or_expr ")" | '"phrase"'[~slop] | wildcard | word+
+    # expand(pattern) gives the terms a wildcard word such as "bóng*" matches, the word
+    # stands for any of them. Without expand wildcards are plain words.
+    tokens = tokenize_query(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def is_operator(token, name=None):
+        return token is not None and token.lower() in ((name,) if name else OPERATORS)
+
+    def is_wildcard(token):
+        return expand is not None and term_dictionary.has_wildcard(token) and not token.startswith('"')
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while is_operator(peek(), "or"):
+            position += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and():
+        nonlocal position
+        children = [parse_not()]
+        while peek() is not None and peek() != ")" and not is_operator(peek(), "or"):
+            if is_operator(peek(), "and"):
+                position += 1
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def parse_not():
+        nonlocal position
+        if is_operator(peek(), "not"):
+            position += 1
+            return ("not", parse_not())
+        return parse_primary()
+
+    def parse_primary():
+        nonlocal position
+        token = peek()
+        if token is None or token == ")" or is_operator(token):
+            raise ValueError(f"Unexpected {token or 'end of query'!r} in query {query!r}")
+        position += 1
+
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError(f"Missing ')' in query {query!r}")
+            position += 1
+            return node
+
+        match = re.fullmatch(r'"([^"]*)"(?:~(\d+))?', token)
+        if match:
+            return ("phrase", tuple(match.group(1).lower().split()), int(match.group(2) or 0))
+
+        if is_wildcard(token):
+            return ("or", [("phrase", (term,), 0) for term in expand(token.lower())])
+
+        words = [token.lower()]
+        while peek() is not None and peek() not in ("(", ")") and not peek().startswith('"') \
+                and not is_operator(peek()) and not is_wildcard(peek()):
+            words.append(peek().lower())
+            position += 1
+        return ("phrase", tuple(words), 0)
+
+    node = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected {tokens[position]!r} in query {query!r}")
+    return _flatten(node)
+
+
+def _flatten(node):
+    if node[0] in ("and", "or"):
+        children = []
+        for child in map(_flatten, node[1]):
+            if child[0] == node[0]:
+                children.extend(child[1])
+            else:
+                children.append(child)
+        return (node[0], children)
+    if node[0] == "not":
+        return ("not", _flatten(node[1]))
+    return node
+
+
+class BooleanEvaluator:
+    # Evaluates parsed queries on bitmaps over dense integer doc ids of one index
+
+    def __init__(self, index):
+        self.index = index
+        self.doc_ids = list(index["metadata"])
+        self.doc_numbers = {doc_id: number for number, doc_id in enumerate(self.doc_ids)}
+        self.universe = Bitmap.full(len(self.doc_ids))
+
+    def estimate(self, node):
+        # Cheap upper bound on the result size, used to order conjunctions
+        tokens = self.index["tokens"]
+        kind = node[0]
+        if kind == "phrase":
+            if not node[1]:
+                return 0
+            if hasattr(tokens, "document_frequency"):
+                return min(tokens.document_frequency(word) for word in node[1])
+            return min(len(tokens.get(word, {})) for word in node[1])
+        if kind == "and":
+            positives = [self.estimate(child) for child in node[1] if child[0] != "not"]
+            return min(positives, default=len(self.doc_ids))
+        if kind == "or":
+            return sum(self.estimate(child) for child in node[1])
+        return len(self.doc_ids)
+
+    def evaluate(self, node, universe=None, variants=None):
+        universe = self.universe if universe is None else universe
+        kind = node[0]
+
+        if kind == "phrase":
+            tokens = self.index["tokens"]
+            if variants is None:
+                token_data = [tokens.get(word, {}) for word in node[1]]
+            else:
+                # Each word also matches its unaccented and misspelled forms
+                token_data = [
+                    variant_index.variant_postings(tokens, variant_index.expand_word(word, variants))
+                    for word in node[1]
+                ]
+            if not token_data or not all(token_data):
+                return Bitmap()
+            if len(token_data) == 1:
+                docs = token_data[0]
+            else:
+                docs = phrase.phrase_documents(token_data, slop=node[2])
+            return Bitmap.from_ids(self.doc_numbers[doc] for doc in docs) & universe
+
+        if kind == "not":
+            # Only what the query spells out is excluded, never a variant of it
+            return universe - self.evaluate(node[1], universe)
+
+        if kind == "or":
+            result = Bitmap()
+            for child in node[1]:
+                result = result | self.evaluate(child, universe, variants)
+            return result
+
+        # AND: positive operands smallest first, negations applied afterwards as set
+        # differences, stopping as soon as the intersection is empty
+        positives = sorted((child for child in node[1] if child[0] != "not"), key=self.estimate)
+        negatives = [child[1] for child in node[1] if child[0] == "not"]
+
+        result = universe
+        for child in positives:
+            result = result & self.evaluate(child, result, variants)
+            if not result.containers:
+                return result
+        for child in negatives:
+            result = result - self.evaluate(child, result)
+            if not result.containers:
+                return result
+        return result
+
+    def search(self, query, doc_filter=None, top_k=None, variants=None):
+        universe = None
+        if doc_filter is not None:
+            universe = Bitmap.from_ids(self.doc_numbers[doc] for doc in doc_filter if doc in self.doc_numbers)
+
+        # Every term a wildcard matches, so sharded indexes agree with a single one
+        terms = term_dictionary.get_term_dictionary(self.index)
+        result = self.evaluate(parse_query(query, lambda pattern: terms.expand(pattern, None)), universe, variants)
+
+        if doc_filter is None:
+            doc_ids = [self.doc_ids[number] for number in result]
+        else:
+            # Keep the filter's order (newest first for time ranges)
+            doc_ids = [doc for doc in doc_filter if doc in self.doc_numbers and self.doc_numbers[doc] in result]
+        return doc_ids[:top_k]
+
+
+_evaluator = None
+
+
+def get_evaluator(index):
+    # Doc numbering and the universe bitmap are reused while the same index is searched
+    global _evaluator
+    if _evaluator is None or _evaluator.index is not index:
+        _evaluator = BooleanEvaluator(index)
+    return _evaluator
@@ -0,0 +1,152 @@
+﻿from array import array
+from operator import sub
+from bisect import bisect_left
+from collections.abc import Mapping
+
+
+class DocTable:
+    # Dense doc numbers shared by every posting list of an index, with the way back to post_id
+
+    __slots__ = ("doc_ids", "_numbers")
+
+    def __init__(self, doc_ids, numbers=None):
+        self.doc_ids = doc_ids
+        self._numbers = numbers
+
+    @property
+    def numbers(self):
+        if self._numbers is None:
+            self._numbers = {doc_id: number for number, doc_id in enumerate(self.doc_ids)}
+        return self._numbers
+
+
+class PostingList(Mapping):
+    # One term's postings as sorted doc numbers plus one flat positions array, the
+    # positions of the i-th document are positions[offsets[i]:offsets[i + 1]]. Reads like
+    # the {doc_id: positions} dict it replaces, in the same doc order.
+
+    __slots__ = ("table", "doc_numbers", "offsets", "positions")
+
+    def __init__(self, table, doc_numbers, offsets, positions):
+        self.table = table
+        self.doc_numbers = doc_numbers
+        self.offsets = offsets
+        self.positions = positions
+
+    @classmethod
+    def from_docs(cls, table, docs):
+        doc_numbers = array("I")
+        offsets = array("I", [0])
+        positions = array("I")
+        for number, doc_id in sorted((table.numbers[doc_id], doc_id) for doc_id in docs):
+            doc_numbers.append(number)
+            positions.extend(docs[doc_id])
+            offsets.append(len(positions))
+        return cls(table, doc_numbers, offsets, positions)
+
+    def _find(self, doc_id):
+        number = self.table.numbers.get(doc_id)
+        if number is None:
+            return -1
+        i = bisect_left(self.doc_numbers, number)
+        if i < len(self.doc_numbers) and self.doc_numbers[i] == number:
+            return i
+        return -1
+
+    def positions_at(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def term_frequencies(self):
+        # (doc_id, tf) without slicing any positions
+        offsets = self.offsets
+        return zip(map(self.table.doc_ids.__getitem__, self.doc_numbers), map(sub, offsets[1:], offsets))
+
+    def number_frequencies(self):
+        # (doc number, tf) straight from the arrays, for scoring on doc numbers
+        offsets = self.offsets
+        return zip(self.doc_numbers, map(sub, offsets[1:], offsets))
+
+    def max_term_frequency(self):
+        offsets = self.offsets
+        return max(map(sub, offsets[1:], offsets), default=0)
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.positions_at(i)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __iter__(self):
+        doc_ids = self.table.doc_ids
+        return (doc_ids[number] for number in self.doc_numbers)
+
+    def __len__(self):
+        return len(self.doc_numbers)
+
+    def items(self):
+        doc_ids = self.table.doc_ids
+        for i, number in enumerate(self.doc_numbers):
+            yield doc_ids[number], self.positions_at(i)
+
+
+class CompactPostings(Mapping):
+    # "tokens" part of an index as PostingLists, built from the nested dicts of a JSON index
+
+    def __init__(self, table, postings):
+        self.table = table
+        self.postings = postings
+
+    @classmethod
+    def from_tokens(cls, tokens, doc_ids):
+        table = DocTable(doc_ids)
+        return cls(table, {term: PostingList.from_docs(table, docs) for term, docs in tokens.items()})
+
+    def __getitem__(self, term):
+        return self.postings[term]
+
+    def __contains__(self, term):
+        return term in self.postings
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+    def document_frequencies(self):
+        for term, docs in self.postings.items():
+            yield term, len(docs)
+
+    def document_frequency(self, term):
+        docs = self.postings.get(term)
+        return len(docs) if docs is not None else 0
+
+    def max_term_frequency(self, term):
+        docs = self.postings.get(term)
+        return docs.max_term_frequency() if docs is not None else 0
+
+
+def merge_posting_lists(posting_lists):
+    # One PostingList over the documents of all the lists (of the same table), a document's
+    # positions are the union of its positions in each list
+    merged = {}
+    for docs in posting_lists:
+        for i, number in enumerate(docs.doc_numbers):
+            merged.setdefault(number, []).extend(docs.positions_at(i))
+    doc_numbers = array("I", sorted(merged))
+    offsets = array("I", [0])
+    positions = array("I")
+    for number in doc_numbers:
+        positions.extend(sorted(merged[number]))
+        offsets.append(len(positions))
+    return PostingList(posting_lists[0].table, doc_numbers, offsets, positions)
+
+
+def compact_index(inverted_index):
+    # Same index with compact postings, doc numbers follow the metadata order
+    compact = dict(inverted_index)
+    compact["tokens"] = CompactPostings.from_tokens(inverted_index["tokens"], list(inverted_index["metadata"]))
+    return compact
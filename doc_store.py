@@ -0,0 +1,165 @@
+﻿import os
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+MAGIC = b"SEDS"
+VERSION = 1
+
+RECORDS_FILE = "documents.dat"
+OFFSETS_FILE = "documents.idx"
+
+# magic, format version, compressed flag
+HEADER = struct.Struct("<4sII")
+# block offset, stored block length, record offset inside the block, record length
+ENTRY = struct.Struct("<QIII")
+
+
+class DocumentStoreWriter:
+    # Append-only record file plus a fixed-size offset table, one entry per document.
+    # Records are grouped into blocks of about block_size bytes that are zlib-compressed
+    # together, so similar articles share one compression dictionary.
+
+    def __init__(self, store_dir, compress=True, block_size=64 * 1024):
+        os.makedirs(store_dir, exist_ok=True)
+        offsets_path = os.path.join(store_dir, OFFSETS_FILE)
+
+        if os.path.exists(offsets_path) and os.path.getsize(offsets_path) >= HEADER.size:
+            with open(offsets_path, "rb") as f:
+                magic, version, compressed = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"'{store_dir}' is not a document store")
+            self.compress = bool(compressed)
+            self.offsets = open(offsets_path, "ab")
+        else:
+            self.compress = compress
+            self.offsets = open(offsets_path, "wb")
+            self.offsets.write(HEADER.pack(MAGIC, VERSION, int(compress)))
+
+        self.records = open(os.path.join(store_dir, RECORDS_FILE), "ab")
+        self.block_size = block_size if self.compress else 0
+        self.block = bytearray()
+        self.pending = []
+
+    def add(self, text):
+        record = text.encode("utf-8")
+        self.pending.append((len(self.block), len(record)))
+        self.block += record
+        if len(self.block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = zlib.compress(bytes(self.block)) if self.compress else bytes(self.block)
+        block_offset = self.records.tell()
+        self.records.write(data)
+        for record_offset, record_length in self.pending:
+            self.offsets.write(ENTRY.pack(block_offset, len(data), record_offset, record_length))
+        self.block = bytearray()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.records.close()
+        self.offsets.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DocumentStore(Mapping):
+    # Random access to article bodies by doc id, only the block holding the record is read
+
+    def __init__(self, store_dir, doc_numbers, cache_blocks=8):
+        self.doc_numbers = doc_numbers
+        self.records_path = os.path.join(store_dir, RECORDS_FILE)
+        with open(os.path.join(store_dir, OFFSETS_FILE), "rb") as f:
+            magic, version, compressed = HEADER.unpack(f.read(HEADER.size))
+            self.entries = f.read()
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"'{store_dir}' is not a document store")
+        self.compressed = bool(compressed)
+        self.cache_blocks = cache_blocks
+        self._blocks = OrderedDict()
+        self._blocks_lock = threading.Lock()
+
+    def _block(self, block_offset, block_length):
+        with self._blocks_lock:
+            block = self._blocks.get(block_offset)
+            if block is not None:
+                self._blocks.move_to_end(block_offset)
+                return block
+
+        with open(self.records_path, "rb") as f:
+            f.seek(block_offset)
+            block = f.read(block_length)
+        if self.compressed:
+            block = zlib.decompress(block)
+
+        with self._blocks_lock:
+            self._blocks[block_offset] = block
+            if len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+    def fetch(self, number):
+        block_offset, block_length, record_offset, record_length = ENTRY.unpack_from(
+            self.entries, number * ENTRY.size
+        )
+        block = self._block(block_offset, block_length)
+        return block[record_offset:record_offset + record_length].decode("utf-8")
+
+    def __getitem__(self, doc_id):
+        return self.fetch(self.doc_numbers[doc_id])
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_numbers
+
+    def __iter__(self):
+        return iter(self.doc_numbers)
+
+    def __len__(self):
+        return len(self.doc_numbers)
+
+
+class MetadataColumns(Mapping):
+    # Article metadata kept column by column (one list per field) instead of one dict per
+    # article. Looking up a doc id still returns the familiar metadata dict.
+
+    def __init__(self, doc_ids, columns, doc_numbers=None):
+        self.doc_ids = doc_ids
+        self.columns = columns
+        self.doc_numbers = doc_numbers or {doc_id: number for number, doc_id in enumerate(doc_ids)}
+
+    @classmethod
+    def from_metadata(cls, metadata, exclude=("content",)):
+        doc_ids = list(metadata)
+        names = []
+        for article in metadata.values():
+            for name in article:
+                if name not in exclude and name not in names:
+                    names.append(name)
+        columns = {name: [metadata[doc_id].get(name) for doc_id in doc_ids] for name in names}
+        return cls(doc_ids, columns)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def __getitem__(self, doc_id):
+        number = self.doc_numbers[doc_id]
+        return {name: values[number] for name, values in self.columns.items()}
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_numbers
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def __len__(self):
+        return len(self.doc_ids)
@@ -0,0 +1,219 @@
+﻿import os
+import sys
+import math
+import heapq
+import struct
+from array import array
+
+import indexing
+import binary_index
+import variant_index
+import instrumentation
+
+MODELS = ("cosine", "bm25")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+MAGIC = b"SEIM"
+VERSION = 1
+# magic, format version, bits per impact, posting count, scale of the largest impact
+HEADER = struct.Struct("<4sIIId")
+TYPECODES = {8: "B", 16: "H"}
+
+
+def impacts_file(model, bits):
+    return f"impacts_{model}_{bits}.bin"
+
+
+def document_lengths(metadata, doc_ids):
+    # Word counts stored at index time, BM25 normalizes by them
+    if hasattr(metadata, "column") and "word_count" in metadata.columns:
+        return [count or 0 for count in metadata.column("word_count")]
+    return [metadata[doc_id].get("word_count") or 0 for doc_id in doc_ids]
+
+
+def raw_impacts(term_postings, model, doc_count, doc_lengths):
+    # Generator factory: for every term (in term_postings order) the float score one
+    # occurrence of the term in a query adds to each of its documents.
+    #   cosine: idf * (1 + log tf) * idf / |d|, document vectors normalized to unit length
+    #   bm25:   idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl))
+    if model == "cosine":
+        norms = array("d", [0.0]) * doc_count
+        for _, doc_numbers, frequencies in term_postings():
+            idf = 1 + math.log(doc_count / len(doc_numbers))
+            for number, tf in zip(doc_numbers, frequencies):
+                norms[number] += ((1 + math.log(tf)) * idf) ** 2
+        norms = array("d", map(math.sqrt, norms))
+
+        def impacts():
+            for term, doc_numbers, frequencies in term_postings():
+                idf = 1 + math.log(doc_count / len(doc_numbers))
+                yield term, doc_numbers, [
+                    idf * (1 + math.log(tf)) * idf / norms[number] for number, tf in zip(doc_numbers, frequencies)
+                ]
+    elif model == "bm25":
+        average_length = sum(doc_lengths) / doc_count if doc_count else 0
+        # Same length for every document when there are no word counts, plain saturation then
+        average_length = average_length or 1
+        lengths = [length or average_length for length in doc_lengths]
+
+        def impacts():
+            for term, doc_numbers, frequencies in term_postings():
+                df = len(doc_numbers)
+                idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                yield term, doc_numbers, [
+                    idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths[number] / average_length))
+                    for number, tf in zip(doc_numbers, frequencies)
+                ]
+    else:
+        raise ValueError(f"Unknown scoring model {model!r}, expected one of {', '.join(MODELS)}")
+    return impacts
+
+
+def quantize(impacts, bits):
+    # Uniform quantization against the largest impact of the whole index, so quantized
+    # impacts of different terms stay comparable. Every posting keeps at least 1.
+    scale = max((max(values, default=0) for _, _, values in impacts()), default=0) or 1.0
+    levels = (1 << bits) - 1
+
+    def quantized():
+        for term, doc_numbers, values in impacts():
+            yield term, doc_numbers, array(TYPECODES[bits], [max(1, round(value / scale * levels)) for value in values])
+    return quantized, scale
+
+
+def index_term_postings(inverted_index, doc_numbers):
+    # (term, doc numbers, term frequencies) for indexes without a postings file
+    def term_postings():
+        for term, docs in inverted_index["tokens"].items():
+            if hasattr(docs, "term_frequencies"):
+                term_frequencies = docs.term_frequencies()
+            else:
+                term_frequencies = ((doc_id, len(positions)) for doc_id, positions in docs.items())
+            pairs = sorted((doc_numbers[doc_id], tf) for doc_id, tf in term_frequencies)
+            yield term, array("I", [number for number, _ in pairs]), array("I", [tf for _, tf in pairs])
+    return term_postings
+
+
+def write_impacts(index_dir, model, bits=8):
+    # Impacts of a binary index in postings order, one 8 or 16 bit value per posting
+    if bits not in TYPECODES:
+        raise ValueError(f"Impacts are stored with 8 or 16 bits, not {bits}")
+    index = binary_index.load_binary_index(index_dir)
+    tokens = index["tokens"]
+    doc_lengths = document_lengths(index["metadata"], tokens.doc_ids)
+    impacts = raw_impacts(tokens.term_postings, model, len(tokens.doc_ids), doc_lengths)
+    quantized, scale = quantize(impacts, bits)
+
+    path = os.path.join(index_dir, impacts_file(model, bits))
+    posting_count = 0
+    with open(path + ".tmp", "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, bits, 0, scale))
+        for _, _, values in quantized():
+            if sys.byteorder != "little":
+                values.byteswap()
+            f.write(values.tobytes())
+            posting_count += len(values)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, bits, posting_count, scale))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+class ImpactScorer:
+    # Ranked retrieval on precomputed, quantized impacts: a query only adds up small
+    # integers from the postings of its terms, no document vectors are needed. A term
+    # repeated in the query counts once per occurrence.
+
+    def __init__(self, doc_ids, doc_numbers, lookup, model, bits, scale):
+        self.doc_ids = doc_ids
+        self.doc_numbers = doc_numbers
+        self.lookup = lookup
+        self.model = model
+        self.bits = bits
+        self.scale = scale
+
+    @classmethod
+    def open(cls, index_dir, index, model, bits=8):
+        # Impacts stored next to a binary index, written on first use
+        path = os.path.join(index_dir, impacts_file(model, bits))
+        if not os.path.exists(path):
+            print(f"Computing {model} impacts ({bits} bits) for '{index_dir}'...")
+            write_impacts(index_dir, model, bits)
+
+        with open(path, "rb") as f:
+            magic, version, stored_bits, posting_count, scale = HEADER.unpack(f.read(HEADER.size))
+            impacts = array(TYPECODES[stored_bits])
+            impacts.frombytes(f.read())
+        if magic != MAGIC or version != VERSION or len(impacts) != posting_count:
+            raise ValueError(f"'{path}' is not a valid impacts file")
+        if sys.byteorder != "little":
+            impacts.byteswap()
+
+        tokens = index["tokens"]
+
+        def lookup(term):
+            first, doc_numbers = tokens.posting_numbers(term)
+            return doc_numbers, impacts[first:first + len(doc_numbers)]
+
+        doc_numbers = getattr(index["metadata"], "doc_numbers", None) or tokens.table.numbers
+        return cls(tokens.doc_ids, doc_numbers, lookup, model, stored_bits, scale)
+
+    @classmethod
+    def from_index(cls, inverted_index, model, bits=8):
+        # Impacts kept in memory, for indexes that only exist in memory such as segment snapshots
+        doc_ids = list(inverted_index["metadata"])
+        doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        term_postings = index_term_postings(inverted_index, doc_numbers)
+        doc_lengths = document_lengths(inverted_index["metadata"], doc_ids)
+        quantized, scale = quantize(raw_impacts(term_postings, model, len(doc_ids), doc_lengths), bits)
+        table = {term: (numbers, values) for term, numbers, values in quantized()}
+
+        def lookup(term):
+            return table.get(term, (array("I"), array(TYPECODES[bits])))
+
+        return cls(doc_ids, doc_numbers, lookup, model, bits, scale)
+
+    def scores(self, query, allowed=None, variants=None):
+        # variants expands query words to weighted spelling variants, see variant_index
+        scores = {}
+        touched = filtered = 0
+        for term, (count, weight) in variant_index.weighted_terms(indexing.tokenize(query), variants).items():
+            doc_numbers, impacts = self.lookup(term)
+            for number, impact in zip(doc_numbers, impacts):
+                if allowed is None or number in allowed:
+                    scores[number] = scores.get(number, 0) + count * impact * weight
+            if instrumentation.enabled:
+                touched += len(doc_numbers)
+                if allowed is not None:
+                    filtered += sum(1 for number in doc_numbers if number not in allowed)
+        if instrumentation.enabled:
+            instrumentation.count("postings_touched", touched)
+            instrumentation.count("candidates_filtered", filtered)
+            instrumentation.count("docs_scored", len(scores))
+        return scores
+
+    def search(self, query, top_k=None, doc_filter=None, variants=None):
+        allowed = None
+        if doc_filter is not None:
+            allowed = {self.doc_numbers[doc_id] for doc_id in doc_filter if doc_id in self.doc_numbers}
+        scores = self.scores(query, allowed, variants)
+
+        # Highest score first, ties broken by doc id like indexing.top_documents
+        doc_ids = self.doc_ids
+        key = lambda x: (-x[1], doc_ids[x[0]])
+        if top_k is None:
+            ranked = sorted(scores.items(), key=key)
+        else:
+            ranked = heapq.nsmallest(top_k, scores.items(), key=key)
+        return [doc_ids[number] for number, _ in ranked]
+
+
+if __name__ == "__main__":
+    # python impact_index.py inverted_index bm25 8
+    if len(sys.argv) not in (3, 4) or sys.argv[2] not in MODELS:
+        print(f"Usage: python impact_index.py <index_dir> <{'|'.join(MODELS)}> [8|16]")
+        sys.exit(1)
+
+    bits = int(sys.argv[3]) if len(sys.argv) == 4 else 8
+    print(f"Impacts written to '{write_impacts(sys.argv[1], sys.argv[2], bits)}'.")
@@ -2,7 +2,23 @@
 import json
 import re
 import math
+import heapq
+import bisect
+import threading
+from array import array
+from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import phrase
+import query_cache
+import compact_index
+import impact_index
+import boolean_query
+import binary_index
+import variant_index
+import term_dictionary
+import instrumentation
 
 # List of stopwords to exclude
 STOPWORDS = set([
@@ -27,194 +43,877 @@ def tokenize(text):
     ]
 
 
-def create_inverted_index(folder_path, index_file):
+def split_wildcards(query):
+    # (tokenize(query) without the wildcard words, the wildcard words such as "bóng*")
+    if not term_dictionary.has_wildcard(query):
+        return tokenize(query), []
+    terms, patterns = [], []
+    for word in query.replace("...", " ").lower().split():
+        if term_dictionary.has_wildcard(word):
+            patterns.append(re.sub(r"[^\w\s*?]", "", term_dictionary.TRAILING_QUESTION.sub("", word)))
+        else:
+            terms.extend(tokenize(word))
+    return terms, patterns
+
+
+def expand_wildcards(terms, patterns, dictionary):
+    # Query terms with each wildcard word replaced by the most frequent terms it matches
+    terms = list(terms)
+    for pattern in patterns:
+        terms.extend(dictionary.expand(pattern))
+    return terms
+
+
+def parse_article_date(date):
+    # Dates look like "DD/MM/YYYY HH:MM GMT+X", fall back to the day alone
+    parts = date.split(" ")
+    for text, date_format in ((" ".join(parts[:2]), "%d/%m/%Y %H:%M"), (parts[0], "%d/%m/%Y")):
+        try:
+            return datetime.strptime(text, date_format).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def read_article(file_path):
+    with open(file_path, 'r', encoding="utf-8") as f:
+        return json.load(f)
+
+
+def article_metadata(content):
+    # (post_id, metadata) of an article as the index stores it
+    post_id = content.get("post_id")
+    title = content.get("title", "Unknown Title")
+    text = content.get("content", "")
+    author = content.get("author", "Unknown Author")
+    date = content.get("date", "Unknown Date")
+    category = content.get("category", "Uncategorized")
+    
+    return post_id, {
+        "title": title,
+        "content": text,
+        "author": author,
+        "date": date,
+        "category": category,
+        "word_count": len(text.split()),
+        "timestamp": parse_article_date(date)
+    }
+
+
+def add_article(inverted_index, content):
+    post_id, metadata = article_metadata(content)
+    inverted_index["metadata"][post_id] = metadata
+    
+    tokens = tokenize(metadata["content"])
+    for position, token in enumerate(tokens):
+        if post_id not in inverted_index["tokens"][token]:
+            inverted_index["tokens"][token][post_id] = []
+        inverted_index["tokens"][token][post_id].append(position)
+
+    return post_id
+
+
+def index_files(folder_path, file_names):
+    partial_index = {"tokens": defaultdict(dict), "metadata": {}}
+
+    for file_name in file_names:
+        file_path = os.path.join(folder_path, file_name)
+        add_article(partial_index, read_article(file_path))
+
+    # Sorted term dictionary, so partial indexes can be combined with a k-way merge
+    partial_index["tokens"] = dict(sorted(partial_index["tokens"].items()))
+    return partial_index
+
+
+def merge_partial_indexes(partial_indexes):
+    inverted_index = {"tokens": {}, "metadata": {}}
+    for partial_index in partial_indexes:
+        inverted_index["metadata"].update(partial_index["metadata"])
+
+    # Terms come out sorted, postings of the same term are appended in partial order
+    streams = [
+        ((term, number, docs) for term, docs in partial_index["tokens"].items())
+        for number, partial_index in enumerate(partial_indexes)
+    ]
+    tokens = inverted_index["tokens"]
+    for term, _, docs in heapq.merge(*streams, key=lambda x: (x[0], x[1])):
+        if term in tokens:
+            tokens[term].update(docs)
+        else:
+            tokens[term] = docs
+
+    return inverted_index
+
+
+def build_inverted_index(folder_path, workers=None):
+    # Files are indexed in name order so doc order never depends on the file system
+    with instrumentation.stage("build.list_files"):
+        file_names = sorted(name for name in os.listdir(folder_path) if name.endswith(".json"))
+    instrumentation.count("documents_indexed", len(file_names))
+
+    if not workers or workers < 2 or len(file_names) < 2:
+        with instrumentation.stage("build.index_files"):
+            return index_files(folder_path, file_names)
+
+    # Contiguous chunks keep the doc order of the serial build, several chunks per
+    # worker even out files of different sizes
+    chunk_count = min(len(file_names), workers * 4)
+    chunk_size = -(-len(file_names) // chunk_count)
+    chunks = [file_names[i:i + chunk_size] for i in range(0, len(file_names), chunk_size)]
+
+    with instrumentation.stage("build.index_files"):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            partial_indexes = list(executor.map(index_files, [folder_path] * len(chunks), chunks))
+
+    with instrumentation.stage("build.merge"):
+        return merge_partial_indexes(partial_indexes)
+
+
+def create_inverted_index(folder_path, index_file, workers=None):
     if os.path.exists(index_file):
         print(f"Index file '{index_file}' already exists. Loading index...")
-        with open(index_file, 'r', encoding="utf-8") as f:
+        with instrumentation.stage("build.load_json"), open(index_file, 'r', encoding="utf-8") as f:
             return json.load(f)
 
     print(f"Index file '{index_file}' not found. Creating a new index...")
-    inverted_index = {"tokens": defaultdict(dict), "metadata": {}}
-    
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith(".json"):
-            file_path = os.path.join(folder_path, file_name)
-            
-            with open(file_path, 'r', encoding="utf-8") as f:
-                content = json.load(f)
-                
-            post_id = content.get("post_id")
-            title = content.get("title", "Unknown Title")
-            text = content.get("content", "")
-            author = content.get("author", "Unknown Author")
-            date = content.get("date", "Unknown Date")
-            category = content.get("category", "Uncategorized")
-            
-            inverted_index["metadata"][post_id] = {
-                "title": title,
-                "content": text,
-                "author": author,
-                "date": date,
-                "category": category,
-                "word_count": len(text.split())
-            }
-            
-            tokens = tokenize(text)
-            for position, token in enumerate(tokens):
-                if post_id not in inverted_index["tokens"][token]:
-                    inverted_index["tokens"][token][post_id] = []
-                inverted_index["tokens"][token][post_id].append(position)
-
-    with open(index_file, 'w', encoding="utf-8") as f:
+    inverted_index = build_inverted_index(folder_path, workers)
+
+    with instrumentation.stage("build.write_json"), open(index_file, 'w', encoding="utf-8") as f:
         json.dump(inverted_index, f, ensure_ascii=False, indent=4)
     print(f"Index created and saved to '{index_file}'.")
 
     return inverted_index
 
 
-def compute_tfidf_vector_space(inverted_index):
+def create_binary_index(folder_path, index_dir, index_file=None, workers=None):
+    if os.path.exists(index_dir):
+        print(f"Binary index '{index_dir}' already exists. Loading index...")
+        with instrumentation.stage("build.load_binary"):
+            return binary_index.load_binary_index(index_dir)
+
+    # An existing JSON index is imported instead of re-tokenizing the corpus
+    if index_file and os.path.exists(index_file):
+        print(f"Importing JSON index '{index_file}'...")
+        with instrumentation.stage("build.load_json"), open(index_file, 'r', encoding="utf-8") as f:
+            inverted_index = json.load(f)
+    else:
+        print(f"Binary index '{index_dir}' not found. Creating a new index...")
+        inverted_index = build_inverted_index(folder_path, workers)
+
+    with instrumentation.stage("build.write_binary"):
+        binary_index.write_binary_index(inverted_index, index_dir)
+    print(f"Index created and saved to '{index_dir}'.")
+
+    with instrumentation.stage("build.load_binary"):
+        return binary_index.load_binary_index(index_dir)
+
+
+def compute_idf(doc_frequencies, document_count):
+    return {term: 1 + math.log(document_count / df) for term, df in doc_frequencies.items() if df > 0}
+
+
+def index_doc_numbers(metadata):
+    # (doc ids, doc id -> number) in metadata order, the numbering compact posting lists use
+    if hasattr(metadata, "doc_numbers"):
+        return metadata.doc_ids, metadata.doc_numbers
+    doc_ids = list(metadata)
+    return doc_ids, {doc_id: number for number, doc_id in enumerate(doc_ids)}
+
+
+class DocumentVectors:
+    # TF-IDF vectors ({term: weight}) in a list indexed by doc number, so ranked retrieval
+    # runs on the doc number arrays of compact posting lists and only the final top k are
+    # turned back into doc ids. id_ranks[number] is the position of the doc id in sorted
+    # order, which breaks score ties by doc id like every other retrieval path.
+
+    __slots__ = ("doc_ids", "doc_numbers", "vectors", "id_ranks")
+
+    def __init__(self, doc_ids, doc_numbers, vectors):
+        self.doc_ids = doc_ids
+        self.doc_numbers = doc_numbers
+        self.vectors = vectors
+        self.id_ranks = array("I", bytes(4 * len(doc_ids)))
+        for rank, number in enumerate(sorted(range(len(doc_ids)), key=doc_ids.__getitem__)):
+            self.id_ranks[number] = rank
+
+    def __getitem__(self, doc_id):
+        return self.vectors[self.doc_numbers[doc_id]]
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def term_numbers(self, tokens, term):
+        # Sorted doc numbers of a term's postings: read from the postings file of a binary
+        # index without decoding positions, the array of a compact posting list as is
+        if hasattr(tokens, "posting_numbers"):
+            return tokens.posting_numbers(term)[1]
+        docs = tokens.get(term, {})
+        if hasattr(docs, "doc_numbers"):
+            return docs.doc_numbers
+        return sorted(self.doc_numbers[doc_id] for doc_id in docs)
+
+    def ranked_ids(self, numbers):
+        # Doc ids of (score, doc number) pairs, highest score first and ties by doc id
+        id_ranks = self.id_ranks
+        return [self.doc_ids[number] for _, number in sorted(numbers, key=lambda x: (-x[0], id_ranks[x[1]]))]
+
+
+def compute_tfidf_vector_space(inverted_index, doc_frequencies=None, document_count=None):
     tokens = inverted_index["tokens"]
     metadata = inverted_index["metadata"]
-    N = len(metadata)
+    # Shards pass the size of the whole collection, so IDF matches the unsharded index
+    N = len(metadata) if document_count is None else document_count
     
     idf = {}
-    for term, docs in tokens.items():
-        df = len(docs)
-        idf[term] = 1 + math.log(N / df)
+    if doc_frequencies is None:
+        for term, docs in tokens.items():
+            df = len(docs)
+            idf[term] = 1 + math.log(N / df)
+    else:
+        # Segmented indexes keep document frequencies up to date, no postings need to be counted
+        idf = compute_idf(doc_frequencies, N)
 
-    document_vectors = {doc_id: {} for doc_id in metadata}
+    doc_ids, doc_numbers = index_doc_numbers(metadata)
+    vectors = [{} for _ in doc_ids]
 
     # Compute TF-IDF for each term in each document
     for term, docs in tokens.items():
-        for doc_id, positions in docs.items():
+        # Compact posting lists give doc numbers and term frequencies without touching the positions
+        if hasattr(docs, "number_frequencies"):
+            term_frequencies = docs.number_frequencies()
+        else:
+            term_frequencies = ((doc_numbers[doc_id], len(positions)) for doc_id, positions in docs.items())
+        for number, f_td in term_frequencies:
             # Compute TF using sublinear scaling
-            f_td = len(positions)  # Term frequency
             tf = 1 + math.log(f_td) if f_td > 0 else 0
             tfidf = tf * idf[term]
-            document_vectors[doc_id][term] = tfidf
+            vectors[number][term] = tfidf
+
+    return DocumentVectors(doc_ids, doc_numbers, vectors), idf
 
-    return document_vectors, idf
 
+def compute_term_upper_bounds(inverted_index, idf):
+    tokens = inverted_index["tokens"]
+    upper_bounds = {}
+
+    for term in idf:
+        # The binary index stores each term's max tf at index time, the JSON index has to scan
+        if hasattr(tokens, "max_term_frequency"):
+            max_tf = tokens.max_term_frequency(term)
+        else:
+            max_tf = max(len(positions) for positions in tokens[term].values())
+        # Highest TF-IDF weight the term can have in any document
+        upper_bounds[term] = (1 + math.log(max_tf)) * idf[term]
+
+    return upper_bounds
+
+
+def build_date_index(metadata):
+    # Timestamp column sorted oldest first, indexes built before timestamps were stored get parsed once here
+    if hasattr(metadata, "column") and "timestamp" in metadata.columns:
+        # Column store: read the timestamp column directly instead of building a dict per article
+        dated_docs = [
+            (timestamp, doc_id) for doc_id, timestamp in zip(metadata.doc_ids, metadata.column("timestamp"))
+            if timestamp is not None
+        ]
+    else:
+        dated_docs = []
+        for doc_id, article in metadata.items():
+            timestamp = article.get("timestamp")
+            if timestamp is None:
+                timestamp = parse_article_date(article.get("date", ""))
+            if timestamp is not None:
+                dated_docs.append((timestamp, doc_id))
+    dated_docs.sort()
+
+    return {
+        "timestamps": [timestamp for timestamp, _ in dated_docs],
+        "doc_ids": [doc_id for _, doc_id in dated_docs],
+    }
 
-def query_to_vector(query, idf):
+
+# Time range options of the UI and the server, in days back from now
+TIME_RANGES = {"Last week": 7, "Last month": 30, "Last year": 365}
+
+
+def time_range_start(time_range, now=None):
+    # Start timestamp of a named time range, None for "Default" (no filter)
+    if time_range not in TIME_RANGES:
+        return None
+    now = datetime.now() if now is None else now
+    return (now - timedelta(days=TIME_RANGES[time_range])).timestamp()
+
+
+def date_range_bounds(date_index, start=None, end=None):
+    # Slice of the date index holding the articles published in [start, end]
+    low = 0 if start is None else bisect.bisect_left(date_index["timestamps"], start)
+    high = len(date_index["timestamps"]) if end is None else bisect.bisect_right(date_index["timestamps"], end)
+    return low, high
+
+
+def docs_in_range(date_index, start=None, end=None):
+    # Doc ids published in [start, end], newest first
+    low, high = date_range_bounds(date_index, start, end)
+    return date_index["doc_ids"][low:high][::-1]
+
+
+def get_article_content(index, doc_id):
+    # Binary indexes keep bodies in a document store, JSON indexes inside the metadata
+    if "documents" in index:
+        return index["documents"].get(doc_id)
+    return index["metadata"].get(doc_id, {}).get("content")
+
+
+def query_to_vector(query, idf, variants=None):
+    # variants(token) gives the weighted spelling variants a token is searched as, see
+    # variant_index; without it every token only matches itself
     tokens = tokenize(query)
-    term_frequencies = {}
-    
-    for token in tokens:
-        if token in idf:
-            term_frequencies[token] = term_frequencies.get(token, 0) + 1
-    
+    term_frequencies = {
+        term: frequency for term, frequency in variant_index.weighted_terms(tokens, variants).items() if term in idf
+    }
+
     # Compute TF-IDF values
     query_vector = {}
-    for term, freq in term_frequencies.items():
+    for term, (freq, weight) in term_frequencies.items():
         # Compute TF using sublinear scaling
         tf = 1 + math.log(freq) if freq > 0 else 0
-        query_vector[term] = tf * idf[term]
+        query_vector[term] = tf * idf[term] * weight
     return query_vector
 
 
-def retrieve_documents(query_vector, document_vectors):
-    results = {}
-
-    # Compute the dot product for each document
-    for doc_id, doc_vector in document_vectors.items():
-        dot_product = sum(
-            query_vector.get(term, 0) * doc_vector.get(term, 0)
-            for term in query_vector
+def top_documents(scores, document_vectors, top_k=None):
+    # Highest score first, ties broken by doc id so every retrieval path agrees on the order.
+    # scores are keyed by doc number, only the returned documents get their doc id back.
+    id_ranks = document_vectors.id_ranks
+    key = lambda x: (-x[1], id_ranks[x[0]])
+    if top_k is None:
+        ranked = sorted(scores.items(), key=key)
+    else:
+        ranked = heapq.nsmallest(top_k, scores.items(), key=key)
+    doc_ids = document_vectors.doc_ids
+    return [doc_ids[number] for number, _ in ranked]
+
+
+def retrieve_documents(query_vector, document_vectors, inverted_index=None, top_k=None, upper_bounds=None,
+                       doc_filter=None):
+    # doc_filter restricts scoring to the given doc ids, e.g. the documents of a time range
+    allowed = None
+    if doc_filter is not None:
+        doc_numbers = document_vectors.doc_numbers
+        allowed = {doc_numbers[doc_id] for doc_id in doc_filter if doc_id in doc_numbers}
+
+    if inverted_index is not None and top_k is not None and upper_bounds is not None:
+        return retrieve_documents_maxscore(
+            query_vector, document_vectors, inverted_index, top_k, upper_bounds, allowed
         )
-        results[doc_id] = dot_product
-
-    # Sort the documents by dot product in descending order
-    sorted_docs = sorted(results.items(), key=lambda x: x[1], reverse=True)
-
-    # Return the document IDs
-    return [doc_id for doc_id, _ in sorted_docs]
 
+    results = {}
+    vectors = document_vectors.vectors
+    tokens = None if inverted_index is None else inverted_index["tokens"]
+
+    if inverted_index is None:
+        # Compute the dot product for each document
+        candidates = range(len(vectors)) if allowed is None else allowed
+        for number in candidates:
+            doc_vector = vectors[number]
+            dot_product = sum(
+                query_vector.get(term, 0) * doc_vector.get(term, 0)
+                for term in query_vector
+            )
+            if dot_product > 0:
+                results[number] = dot_product
+    else:
+        # Term-at-a-time: only the postings of the query terms are visited
+        for term, weight in query_vector.items():
+            for number in document_vectors.term_numbers(tokens, term):
+                if allowed is None or number in allowed:
+                    results[number] = results.get(number, 0) + weight * vectors[number][term]
+
+    if instrumentation.enabled:
+        # Counted after the fact so the loops above stay the same when instrumentation is off
+        if tokens is None:
+            touched = len(vectors) if allowed is None else len(allowed)
+            instrumentation.count("candidates_filtered", len(vectors) - touched)
+        else:
+            touched = sum(len(document_vectors.term_numbers(tokens, term)) for term in query_vector)
+            if allowed is not None:
+                instrumentation.count("candidates_filtered", sum(
+                    1 for term in query_vector
+                    for number in document_vectors.term_numbers(tokens, term) if number not in allowed
+                ))
+        instrumentation.count("postings_touched", touched)
+        instrumentation.count("docs_scored", len(results))
+
+    # Keep the top_k best documents in a bounded heap instead of sorting every score
+    return top_documents(results, document_vectors, top_k)
+
+
+def retrieve_documents_maxscore(query_vector, document_vectors, inverted_index, top_k, upper_bounds, allowed=None):
+    # MaxScore: terms whose combined upper bounds cannot beat the current k-th score are
+    # "non-essential", documents are only drawn from the essential terms' postings and the
+    # non-essential terms are probed while the document can still enter the top k.
+    # Everything runs on doc numbers, allowed is a set of them.
+    tokens = inverted_index["tokens"]
+    vectors = document_vectors.vectors
+    id_ranks = document_vectors.id_ranks
+    terms = sorted(query_vector, key=lambda term: query_vector[term] * upper_bounds[term])
+    postings = [document_vectors.term_numbers(tokens, term) for term in terms]
+    if allowed is None:
+        doc_lists = postings
+    else:
+        doc_lists = [[number for number in numbers if number in allowed] for numbers in postings]
+    pointers = [0] * len(terms)
+
+    cumulative_bounds = []
+    total = 0
+    for term in terms:
+        total += query_vector[term] * upper_bounds[term]
+        cumulative_bounds.append(total)
+
+    def exact_score(doc_vector):
+        # Same summation order as the exhaustive scorer so scores compare bit for bit
+        return sum(query_vector[term] * doc_vector[term] for term in query_vector if term in doc_vector)
+
+    heap = []
+    threshold = 0
+    first_essential = 0
+    counter = 0
+    # Slack for rounding differences between the bounds and the exact score
+    epsilon = 1e-9
+
+    while True:
+        candidate = None
+        for i in range(first_essential, len(terms)):
+            if pointers[i] < len(doc_lists[i]):
+                number = doc_lists[i][pointers[i]]
+                if candidate is None or number < candidate:
+                    candidate = number
+        if candidate is None:
+            break
 
-def exact_match(query, index):
+        doc_vector = vectors[candidate]
+        score = 0
+        for i in range(first_essential, len(terms)):
+            if pointers[i] < len(doc_lists[i]) and doc_lists[i][pointers[i]] == candidate:
+                score += query_vector[terms[i]] * doc_vector[terms[i]]
+                pointers[i] += 1
+
+        heap_full = len(heap) == top_k
+        pruned = False
+        for i in range(first_essential - 1, -1, -1):
+            if heap_full and score + cumulative_bounds[i] < threshold - epsilon:
+                pruned = True
+                break
+            # A document's vector holds exactly the terms whose postings it is in
+            if terms[i] in doc_vector:
+                score += query_vector[terms[i]] * doc_vector[terms[i]]
+
+        if pruned or (heap_full and score < threshold - epsilon):
+            continue
+
+        # The heap keeps the worst entry first: lowest score, then the highest doc id
+        entry = (exact_score(doc_vector), -id_ranks[candidate], candidate)
+        counter += 1
+        if not heap_full:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
+
+        if len(heap) == top_k:
+            threshold = heap[0][0]
+            while first_essential < len(terms) and cumulative_bounds[first_essential] < threshold - epsilon:
+                first_essential += 1
+
+    if instrumentation.enabled:
+        touched = sum(map(len, postings))
+        instrumentation.count("postings_touched", touched)
+        instrumentation.count("candidates_filtered", touched - sum(map(len, doc_lists)))
+        instrumentation.count("docs_scored", counter)
+
+    return document_vectors.ranked_ids((score, number) for score, _, number in heap)
+
+
+def parse_phrase_query(query):
+    # '"a b"' is an exact phrase, '"a b"~3' also matches with up to 3 extra words in between
+    match = re.fullmatch(r'"([^"]*)"(?:~(\d+))?', query)
+    if not match:
+        return None
+    return match.group(1), int(match.group(2) or 0)
+
+
+def exact_match(query, index, doc_filter=None, top_k=None, slop=0, variants=None):
     words = query.lower().split()
     token_data = [index["tokens"].get(word.lower(), {}) for word in words]
 
-    if not all(token_data):
+    results = []
+    if token_data and all(token_data):
+        results = phrase.phrase_documents(token_data, doc_filter, top_k, slop)
+    if variants is None or (top_k is not None and len(results) >= top_k):
+        return results
+    # Exact matches first, then the phrase written with other spellings of its words
+    remaining = None if top_k is None else top_k - len(results)
+    return results + variant_phrase_match(query, index, doc_filter, remaining, slop, variants, results)
+
+
+def variant_phrase_match(query, index, doc_filter=None, top_k=None, slop=0, variants=None, exclude=()):
+    # Docs matching the phrase with any spelling variant of each word, without those in exclude
+    words = query.lower().split()
+    expansions = [variant_index.expand_word(word, variants) for word in words]
+    if all(expansion == [(word, 1.0)] for word, expansion in zip(words, expansions)):
+        return []
+    token_data = [variant_index.variant_postings(index["tokens"], expansion) for expansion in expansions]
+    if not token_data or not all(token_data):
         return []
 
-    result_docs = set(token_data[0].keys())
-    
-    for i in range(1, len(words)):
-        next_docs = set()
-        for doc in result_docs:
-            if doc in token_data[i]:
-                if any(pos + 1 in token_data[i][doc] for pos in token_data[i - 1][doc]):
-                    next_docs.add(doc)
-        result_docs = next_docs
+    exclude = set(exclude)
+    results = []
+    extended_k = None if top_k is None else top_k + len(exclude)
+    for doc_id in phrase.phrase_documents(token_data, doc_filter, extended_k, slop):
+        if doc_id not in exclude:
+            results.append(doc_id)
+            if len(results) == top_k:
+                break
+    return results
 
-    return list(result_docs)
+
+def query_words(query, mode, dictionary=None):
+    # Lowercased words a phrase or boolean query looks up, with the terms its wildcard words
+    # stand for, i.e. the words whose spelling variants it can match
+    if mode == "phrase":
+        phrase_text, _ = parse_phrase_query(query) or (query, 0)
+        return sorted(set(phrase_text.lower().split()))
+    expand = None if dictionary is None else lambda pattern: dictionary.expand(pattern, None)
+    try:
+        nodes = [boolean_query.parse_query(query, expand)]
+    except ValueError:
+        return []
+    words = set()
+    while nodes:
+        node = nodes.pop()
+        if node[0] == "phrase":
+            words.update(node[1])
+        elif node[0] == "not":
+            nodes.append(node[1])
+        else:
+            nodes.extend(node[1])
+    return sorted(words)
 
 
 def contain_logical_operator(query):
     words = query.split()
     for word in words:
+        word = word.strip("()")
         if word == "AND" or word == "OR" or word == "NOT":
             return True
     return False
 
-def exact_match_logical(query, index):
-    words = query.lower().split()
-    count = 0
-    for word in words:
-        if word != "not":
-            break
-        count += 1
-    #print(count)
-    
-    if count != 0:
-        words = words[count:]
-    #print(words)
-    token_data = [index["tokens"].get(word.lower(), {}) for word in words]
-
-    if not all(token_data):
-        return []
-
-    result_docs = set(token_data[0].keys())
-    
-    for i in range(1, len(words)):
-        next_docs = set()
-        for doc in result_docs:
-            if doc in token_data[i]:
-                if any(pos + 1 in token_data[i][doc] for pos in token_data[i - 1][doc]):
-                    next_docs.add(doc)
-        result_docs = next_docs
-
-    if count%2 == 0:
-        return list(result_docs)
-    else:
-        result_list = list(result_docs)
-        all_doc = list(index["metadata"].keys())
-        result = [item for item in all_doc if item not in result_list]
-        return result
-
-def process_logical_operator(query, index):
-    tokens = query.lower().split()
-    query_tokens = re.split(r'\s*(?:\band\b|\bor\b)\s*', query.lower())
-    results = exact_match_logical(query_tokens[0], index)
-    count = 0
-    for token in tokens:
-        if token == "and":
-            count += 1
-            next_doc_id = exact_match_logical(query_tokens[count], index)
-            results = list(set(results) & set(next_doc_id))
-        elif token == "or":
-            count += 1
-            next_doc_id = exact_match_logical(query_tokens[count], index)
-            results = list(set(results) | set(next_doc_id))
-    return results
-
-
-# Path to folder containing JSON files (data)
-folder_path = "D:\\24-25\\HKI 24-25\\IR\\22125042_Assignment1\\data"
-
-# Destination for the inverted_index file (any path you want)
-index_file = "D:\\24-25\\HKI 24-25\\IR\\Assignment 2\\search engine\\search engine\\inverted_index.json"
-
-inverted_index = create_inverted_index(folder_path, index_file)
-vector_space, idf = compute_tfidf_vector_space(inverted_index)
+def query_mode(query):
+    # Mode the UI picks for a query: quoted phrase, boolean query, otherwise ranked
+    if parse_phrase_query(query):
+        return "phrase"
+    if contain_logical_operator(query):
+        return "boolean"
+    return "ranked"
+
+def normalize_query(query, mode):
+    # Queries with the same normalized form always have the same results
+    if mode == "phrase":
+        phrase_text, slop = parse_phrase_query(query) or (query, 0)
+        return tuple(phrase_text.lower().split()), slop
+    if mode == "boolean":
+        return tuple(token.lower() for token in boolean_query.tokenize_query(query))
+    # Ranked scores only depend on the bag of query terms and wildcard words
+    terms, patterns = split_wildcards(query)
+    return tuple(sorted(terms + patterns))
+
+def exact_match_logical(query, index, doc_filter=None):
+    # Kept for callers of the old per-operand helper, "NOT ... phrase" is just a small boolean query
+    return process_logical_operator(query, index, doc_filter)
+
+def process_logical_operator(query, index, doc_filter=None, top_k=None, variants=None):
+    # AND binds tighter than OR, NOT tighter than both, parentheses and quoted phrases are
+    # supported. Evaluation runs on compressed bitmaps over integer doc ids. Malformed
+    # queries such as "bóng AND" raise a ValueError saying what is wrong.
+    return boolean_query.get_evaluator(index).search(query, doc_filter, top_k, variants)
+
+
+# Derived data of a SearchIndex, each built under a lock of its own
+DERIVED_DATA = ("date_index", "doc_numbers", "vectors", "impacts", "variants")
+
+
+class SearchIndex:
+    # Search engine over one index with explicit configuration. Nothing is loaded on
+    # construction: the index is opened on first use, the date index is built for the
+    # first time range and TF-IDF vectors for the first ranked query, so each process
+    # only pays for the query types it runs. warm_up() prepares everything in the background.
+    # cached_search() answers repeated queries from a result cache, reload() bumps the
+    # generation so results of the previous index are never served again.
+    # scoring="tfidf" ranks by the raw TF-IDF dot product, "cosine" and "bm25" by impacts
+    # precomputed at index time (see impact_index), without building document vectors.
+    # With variants=True query words typed without diacritics also match their accented
+    # forms, and unknown words their nearest correct spelling, weighted below exact matches
+    # (see variant_index).
+
+    def __init__(self, folder_path, index_dir, index_file=None, workers=None, cache_size=1024,
+                 scoring="tfidf", impact_bits=8, variants=True):
+        self.folder_path = folder_path
+        self.index_dir = index_dir
+        self.index_file = index_file
+        self.workers = workers
+        self.scoring = scoring
+        self.impact_bits = impact_bits
+        self.use_variants = variants
+        self.generation = 0
+        self.result_cache = query_cache.QueryCache(cache_size)
+        self._lock = threading.RLock()
+        self._inverted_index = None
+        # Data derived from the current index by name, see _derived()
+        self._derived_data = {}
+        self._build_locks = {name: threading.Lock() for name in DERIVED_DATA}
+        self._warm_up_thread = None
+
+    @classmethod
+    def from_inverted_index(cls, inverted_index):
+        # Engine over an index that is already in memory, e.g. a segment snapshot. Nested
+        # dict postings are converted to compact posting lists first.
+        if isinstance(inverted_index["tokens"], dict):
+            inverted_index = compact_index.compact_index(inverted_index)
+        engine = cls(None, None)
+        engine._inverted_index = inverted_index
+        return engine
+
+    @property
+    def inverted_index(self):
+        if self._inverted_index is None:
+            with self._lock:
+                if self._inverted_index is None:
+                    self._inverted_index = create_binary_index(
+                        self.folder_path, self.index_dir, self.index_file, self.workers
+                    )
+        return self._inverted_index
+
+    def _version(self):
+        # (generation, index) of the current version, read together
+        with self._lock:
+            return self.generation, self.inverted_index
+
+    def _derived(self, name, build, version=None):
+        # Data derived from one version of the index, built on first use. The shared lock is
+        # only held to look the data up and to publish it; the build itself holds a lock of
+        # its own, so a query that does not need this data never waits for it. Data built
+        # for a version a reload() replaced meanwhile goes to its caller but is not kept.
+        generation, index = self._version() if version is None else version
+        with self._lock:
+            if generation == self.generation and name in self._derived_data:
+                return self._derived_data[name]
+        with self._build_locks[name]:
+            with self._lock:
+                if generation == self.generation and name in self._derived_data:
+                    return self._derived_data[name]
+            data = build(index)
+            with self._lock:
+                if generation == self.generation:
+                    self._derived_data[name] = data
+        return data
+
+    @property
+    def date_index(self):
+        return self._derived("date_index", self._build_date_index)
+
+    def doc_numbers(self):
+        # (doc ids, doc id -> number), cached results are stored as arrays of these numbers
+        return self._derived("doc_numbers", self._build_doc_numbers)
+
+    def reload(self, inverted_index=None):
+        # Switch to a new version of the index: the given one (e.g. a new segment snapshot)
+        # or, without one, the index re-read from index_dir on the next query. That is not a
+        # rebuild: the folder is only indexed again when index_dir has been removed. Derived
+        # data is rebuilt lazily.
+        if inverted_index is None and self.index_dir is None:
+            raise ValueError("An engine without an index directory can only reload a given index")
+        with self._lock:
+            self._inverted_index = inverted_index
+            self._derived_data = {}
+            self.generation += 1
+
+    def state(self, mode="ranked", dated=False):
+        # One version of the index with everything a query of this mode reads: a reload()
+        # running meanwhile never pairs the postings of one version with the vectors or doc
+        # numbers of another. Derived data a query does not need (vectors for phrase queries,
+        # the date index without a time range) is neither built nor waited for.
+        version = self._version()
+        doc_ids, doc_numbers = self._derived("doc_numbers", self._build_doc_numbers, version)
+        state = {
+            "generation": version[0],
+            "index": version[1],
+            "doc_ids": doc_ids,
+            "doc_numbers": doc_numbers,
+            "variants": self._derived("variants", self._build_variants, version) if self.use_variants else None,
+            "date_index": self._derived("date_index", self._build_date_index, version) if dated else None,
+            "vectors": None,
+            "impacts": None,
+        }
+        if mode == "ranked":
+            if self.scoring == "tfidf":
+                state["vectors"] = self._derived("vectors", self._build_vectors, version)
+            else:
+                state["impacts"] = self._derived("impacts", self._build_impacts, version)
+        return state
+
+    def vectors(self):
+        # (document vectors, idf, term upper bounds), computed on the first ranked query
+        return self._derived("vectors", self._build_vectors)
+
+    def impacts(self):
+        # Impact scorer for the cosine and BM25 models, stored next to a binary index
+        return self._derived("impacts", self._build_impacts)
+
+    def variants(self):
+        # Spelling variants of query words, None when turned off
+        if not self.use_variants:
+            return None
+        return self._derived("variants", self._build_variants)
+
+    def _build_date_index(self, index):
+        with instrumentation.stage("load.date_index"):
+            return build_date_index(index["metadata"])
+
+    def _build_doc_numbers(self, index):
+        return index_doc_numbers(index["metadata"])
+
+    def _build_vectors(self, index):
+        tokens = index["tokens"]
+        with instrumentation.stage("load.tfidf_vectors"):
+            # Binary indexes and segment snapshots know their document frequencies,
+            # IDF then needs no pass over the postings
+            doc_frequencies = None
+            if hasattr(tokens, "document_frequencies"):
+                doc_frequencies = dict(tokens.document_frequencies())
+            vector_space, idf = compute_tfidf_vector_space(index, doc_frequencies, len(index["metadata"]))
+            upper_bounds = compute_term_upper_bounds(index, idf)
+        return vector_space, idf, upper_bounds
+
+    def _build_impacts(self, index):
+        with instrumentation.stage("load.impacts"):
+            if self.index_dir and hasattr(index["tokens"], "posting_numbers"):
+                return impact_index.ImpactScorer.open(self.index_dir, index, self.scoring, self.impact_bits)
+            return impact_index.ImpactScorer.from_index(index, self.scoring, self.impact_bits)
+
+    def _build_variants(self, index):
+        # Binary indexes store the tables next to their segment files, other indexes get
+        # them built in memory
+        tokens = index["tokens"]
+        with instrumentation.stage("load.variants"):
+            if self.index_dir and hasattr(tokens, "document_frequencies"):
+                return variant_index.VariantIndex.open(self.index_dir, tokens)
+            if hasattr(tokens, "document_frequencies"):
+                return variant_index.VariantIndex.from_frequencies(dict(tokens.document_frequencies()))
+            return variant_index.VariantIndex.from_frequencies({term: len(docs) for term, docs in tokens.items()})
+
+    def terms(self):
+        # Sorted vocabulary for completions and wildcard words, shared with the boolean evaluator
+        return term_dictionary.get_term_dictionary(self.inverted_index)
+
+    def complete(self, prefix, limit=10):
+        return self.terms().complete(prefix.lower(), limit)
+
+    def warm_up(self, background=True):
+        def load_all():
+            self.date_index
+            self.variants()
+            if self.scoring == "tfidf":
+                self.vectors()
+            else:
+                self.impacts()
+
+        if not background:
+            load_all()
+        elif self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=load_all, daemon=True)
+            self._warm_up_thread.start()
+
+    def time_window(self, start=None, end=None):
+        date_index = self.date_index
+        with instrumentation.stage("date_filter"):
+            return docs_in_range(date_index, start, end)
+
+    def ranked_search(self, query, top_k=None, doc_filter=None, state=None):
+        state = self.state("ranked") if state is None else state
+        with instrumentation.stage("tokenize"):
+            query_tokens, patterns = split_wildcards(query) # remove stop words and clean query
+        if patterns:
+            dictionary = term_dictionary.get_term_dictionary(state["index"])
+            with instrumentation.stage("expand_wildcards"):
+                query_tokens = expand_wildcards(query_tokens, patterns, dictionary)
+        variants = state["variants"]
+        if state["impacts"] is not None:
+            with instrumentation.stage("impact_scoring"):
+                return state["impacts"].search(
+                    " ".join(query_tokens) if patterns else query, top_k, doc_filter, variants
+                )
+        vector_space, idf, upper_bounds = state["vectors"]
+        inverted_index = state["index"]
+        with instrumentation.stage("query_to_vector"):
+            query_vector = query_to_vector(" ".join(query_tokens), idf, variants)
+        with instrumentation.stage("retrieve_documents"):
+            return retrieve_documents(
+                query_vector, vector_space, inverted_index, top_k, upper_bounds, doc_filter
+            )
+
+    def search(self, query, top_k=None, doc_filter=None, mode="auto", state=None):
+        # Same dispatch as the UI unless a mode is given: quoted phrase, boolean query, otherwise ranked.
+        # state is the index version to search, see state()
+        mode = query_mode(query) if mode == "auto" else mode
+        state = self.state(mode) if state is None else state
+        if mode == "phrase":
+            phrase_text, slop = parse_phrase_query(query) or (query, 0)
+            with instrumentation.stage("phrase_match"):
+                return exact_match(phrase_text, state["index"], doc_filter, top_k, slop, state["variants"])
+        if mode == "boolean":
+            with instrumentation.stage("boolean_match"):
+                return process_logical_operator(query, state["index"], doc_filter, top_k, state["variants"])
+        return self.ranked_search(query, top_k, doc_filter, state)
+
+    def cached_search(self, query, top_k=None, start=None, end=None, mode="auto"):
+        # search() restricted to articles published in [start, end], through the result cache.
+        # The time range is keyed by the slice of the date index it selects, so a sliding
+        # "Last week" keeps hitting until an article enters or leaves the window.
+        # Lookup, search and caching all use one version of the index, see state()
+        mode = query_mode(query) if mode == "auto" else mode
+        with instrumentation.query(query, mode=mode, top_k=top_k, start=start, end=end):
+            dated = start is not None or end is not None
+            state = self.state(mode, dated)
+            doc_ids, doc_numbers = state["doc_ids"], state["doc_numbers"]
+            window = None
+            if dated:
+                with instrumentation.stage("date_filter"):
+                    window = date_range_bounds(state["date_index"], start, end)
+            key = (mode, normalize_query(query, mode), window, top_k)
+
+            numbers = self.result_cache.get(state["generation"], key)
+            if numbers is not None:
+                instrumentation.count("cache_hits")
+                return [doc_ids[number] for number in numbers]
+
+            doc_filter = None
+            if window is not None:
+                with instrumentation.stage("date_filter"):
+                    doc_filter = state["date_index"]["doc_ids"][window[0]:window[1]][::-1]
+            results = self.search(query, top_k, doc_filter, mode, state)
+            self.result_cache.put(state["generation"], key, array("I", [doc_numbers[doc_id] for doc_id in results]))
+            return results
+
+    def cache_stats(self):
+        stats = {"results": self.result_cache.stats()}
+        tokens = self.inverted_index["tokens"]
+        if hasattr(tokens, "cache_stats"):
+            stats["postings"] = tokens.cache_stats()
+        return stats
+
+    def metadata(self, doc_id):
+        return self.inverted_index["metadata"].get(doc_id, {})
+
+    def content(self, doc_id):
+        return get_article_content(self.inverted_index, doc_id)
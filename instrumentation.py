@@ -0,0 +1,298 @@
+﻿import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+
+# Off by default: stage() then hands out one shared no-op context and count() returns at once
+enabled = False
+slow_query_seconds = None
+slow_query_log = None
+profiler = None
+
+# Upper bounds (seconds) of the Prometheus histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+NULL_STAGE = nullcontext()
+_local = threading.local()
+
+
+class Metrics:
+    # Stage durations as histograms plus plain counters, shared by all threads
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(BUCKETS)}
+            stage["count"] += 1
+            stage["sum"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stage["buckets"][i] += 1
+                    break
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def reset(self):
+        self.drain()
+
+    def drain(self):
+        # Everything recorded so far, cleared; a worker process hands this to merge() of the server's
+        with self._lock:
+            state = (self.stages, dict(self.counters))
+            self.stages = {}
+            self.counters = defaultdict(int)
+        return state
+
+    def merge(self, state):
+        stages, counters = state
+        with self._lock:
+            for name, other in stages.items():
+                stage = self.stages.get(name)
+                if stage is None:
+                    self.stages[name] = other
+                    continue
+                stage["count"] += other["count"]
+                stage["sum"] += other["sum"]
+                stage["max"] = max(stage["max"], other["max"])
+                stage["buckets"] = [a + b for a, b in zip(stage["buckets"], other["buckets"])]
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages": {
+                    name: {
+                        "count": stage["count"],
+                        "sum_s": stage["sum"],
+                        "mean_ms": stage["sum"] / stage["count"] * 1000,
+                        "max_ms": stage["max"] * 1000,
+                    }
+                    for name, stage in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self, prefix="search"):
+        # Prometheus text exposition format, one histogram labelled by stage
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per query or build stage.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name, stage in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, stage["buckets"]):
+                    cumulative += bucket
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {stage["count"]}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stage["sum"]}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # .prom files get the Prometheus text format (e.g. for the node exporter's textfile
+        # collector), anything else JSON
+        text = self.prometheus() if path.endswith(".prom") else json.dumps(self.snapshot(), indent=4)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
+
+
+class Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        metrics.observe(self.name, seconds)
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace["stages"][self.name] = trace["stages"].get(self.name, 0) + seconds
+
+
+def stage(name):
+    if not enabled:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def count(name, value=1):
+    if not enabled:
+        return
+    metrics.count(name, value)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["counters"][name] = trace["counters"].get(name, 0) + value
+
+
+class QueryTrace:
+    # Times one whole search and collects its stages and counters for the slow query log
+
+    __slots__ = ("query", "details", "start")
+
+    def __init__(self, query, details):
+        self.query = query
+        self.details = details
+
+    def __enter__(self):
+        _local.trace = {"stages": {}, "counters": {}}
+        if profiler is not None:
+            profiler.add_thread()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        trace = _local.trace
+        _local.trace = None
+        if profiler is not None:
+            profiler.remove_thread()
+        metrics.observe("query", seconds)
+        metrics.count("queries")
+
+        if slow_query_seconds is not None and seconds >= slow_query_seconds:
+            metrics.count("slow_queries")
+            entry = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "query": self.query,
+                "took_ms": seconds * 1000,
+                "stages_ms": {name: value * 1000 for name, value in trace["stages"].items()},
+                "counters": trace["counters"],
+            }
+            entry.update(self.details)
+            line = json.dumps(entry, ensure_ascii=False)
+            if slow_query_log:
+                with open(slow_query_log, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            else:
+                print(f"Slow query: {line}", file=sys.stderr)
+
+
+def query(text, **details):
+    if not enabled or getattr(_local, "trace", None) is not None:
+        return NULL_STAGE
+    return QueryTrace(text, details)
+
+
+class SamplingProfiler:
+    # Samples the stacks of threads that are inside a query every interval seconds and
+    # counts them in the collapsed format flame graph tools read ("a;b;c count"). The file
+    # is rewritten every write_every seconds, so processes that get killed still leave one.
+
+    def __init__(self, path, interval=0.005, write_every=10.0):
+        self.path = path
+        self.interval = interval
+        self.write_every = write_every
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.threads = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._switch_interval = None
+
+    def add_thread(self):
+        self.threads[threading.get_ident()] += 1
+
+    def remove_thread(self):
+        ident = threading.get_ident()
+        self.threads[ident] -= 1
+        if self.threads[ident] <= 0:
+            del self.threads[ident]
+
+    def start(self):
+        # The sampler only runs when the searching thread lets go of the GIL, which by default
+        # happens every 5 ms: longer than most queries. Switch at the sampling interval instead.
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval))
+        self._thread.start()
+        return self
+
+    def _run(self):
+        last_write = time.monotonic()
+        while not self._stop.wait(self.interval):
+            if time.monotonic() - last_write >= self.write_every:
+                self.write()
+                last_write = time.monotonic()
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.samples += 1
+
+    def write(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write(f"{stack} {samples}\n")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+        self.write()
+
+
+def configure(enable=True, slow_query_ms=None, slow_log=None, profile=None, profile_interval=0.005):
+    # Turns instrumentation on or off. slow_query_ms logs queries at least that slow (to
+    # slow_log as JSON lines, or stderr), profile samples query stacks into that file.
+    global enabled, slow_query_seconds, slow_query_log, profiler
+    if profiler is not None:
+        profiler.stop()
+        profiler = None
+    enabled = enable
+    slow_query_seconds = None if slow_query_ms is None else slow_query_ms / 1000
+    slow_query_log = slow_log
+    if enable and profile:
+        profiler = SamplingProfiler(profile, profile_interval).start()
+
+
+def shutdown(metrics_file=None):
+    # Stops the profiler (writing its samples) and saves the metrics, if asked to
+    configure(False)
+    if metrics_file:
+        metrics.write(metrics_file)
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", action="store_true", help="collect per-stage timings and counters")
+    parser.add_argument("--metrics-file", help="write metrics on exit, .prom for Prometheus text, else JSON")
+    parser.add_argument("--slow-query-ms", type=float, help="log searches slower than this")
+    parser.add_argument("--slow-query-log", help="file for slow searches (JSON lines), default stderr")
+    parser.add_argument("--profile", help="sample the stacks of running searches into this file")
+
+
+def configure_from_args(args):
+    enable = bool(args.metrics or args.metrics_file or args.slow_query_ms is not None or args.profile)
+    if enable:
+        configure(True, args.slow_query_ms, args.slow_query_log, args.profile)
+    return enable
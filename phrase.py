@@ -0,0 +1,109 @@
+﻿from bisect import bisect_left
+
+
+def gallop(values, target, low=0):
+    # Index of the first value >= target at or after low, probing 1, 2, 4, ... steps ahead
+    # before the binary search so short skips stay cheap
+    step = 1
+    high = low
+    while high < len(values) and values[high] < target:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(values, target, low, min(high, len(values)))
+
+
+def intersect_positions(first, second, shift):
+    # Positions p of first with p + shift in second, both lists sorted
+    result = []
+    j = 0
+    for position in first:
+        j = gallop(second, position + shift, j)
+        if j == len(second):
+            break
+        if second[j] == position + shift:
+            result.append(position)
+    return result
+
+
+def phrase_positions(position_lists):
+    # Start positions where the i-th term of the phrase sits at start + i, for the whole chain
+    starts = position_lists[0]
+    for i in range(1, len(position_lists)):
+        if not starts:
+            break
+        starts = intersect_positions(starts, position_lists[i], i)
+    return starts
+
+
+def proximity_match(position_lists, slop):
+    # Terms in phrase order with at most slop extra words over the whole span. For a fixed
+    # start the earliest next occurrence of each term gives the shortest span, and the
+    # pointers only move forward, so every position list is walked once.
+    pointers = [0] * len(position_lists)
+    for start in position_lists[0]:
+        previous = start
+        for i in range(1, len(position_lists)):
+            pointers[i] = gallop(position_lists[i], previous + 1, pointers[i])
+            if pointers[i] == len(position_lists[i]):
+                return False
+            previous = position_lists[i][pointers[i]]
+        if previous - start - (len(position_lists) - 1) <= slop:
+            return True
+    return False
+
+
+def match_phrase(token_data, doc, slop=0):
+    position_lists = [docs[doc] for docs in token_data]
+    if slop == 0:
+        return bool(phrase_positions(position_lists))
+    return proximity_match(position_lists, slop)
+
+
+def compact_phrase_documents(token_data, top_k=None, slop=0):
+    # Same as phrase_documents on compact posting lists: the sorted doc number arrays are
+    # intersected by galloping and positions are sliced out of the flat arrays
+    order = sorted(range(len(token_data)), key=lambda i: len(token_data[i]))
+    pointers = [0] * len(token_data)
+    doc_ids = token_data[0].table.doc_ids
+
+    result_docs = []
+    for first, number in enumerate(token_data[order[0]].doc_numbers):
+        pointers[order[0]] = first
+        for i in order[1:]:
+            doc_numbers = token_data[i].doc_numbers
+            pointers[i] = gallop(doc_numbers, number, pointers[i])
+            if pointers[i] == len(doc_numbers):
+                return result_docs
+            if doc_numbers[pointers[i]] != number:
+                break
+        else:
+            position_lists = [docs.positions_at(pointer) for docs, pointer in zip(token_data, pointers)]
+            matched = bool(phrase_positions(position_lists)) if slop == 0 else proximity_match(position_lists, slop)
+            if matched:
+                result_docs.append(doc_ids[number])
+                if len(result_docs) == top_k:
+                    break
+    return result_docs
+
+
+def phrase_documents(token_data, doc_filter=None, top_k=None, slop=0):
+    # token_data holds one {doc: positions} posting list per phrase term, in phrase order.
+    # Docs are intersected starting from the shortest list before positions are compared.
+    if doc_filter is None and all(hasattr(docs, "doc_numbers") for docs in token_data):
+        if all(docs.table is token_data[0].table for docs in token_data):
+            return compact_phrase_documents(token_data, top_k, slop)
+    ordered = sorted(token_data, key=len)
+    if doc_filter is None:
+        candidates = ordered[0]
+    else:
+        # Walk the filter in its own order (newest first for time ranges) and stop after top_k matches
+        candidates = (doc for doc in doc_filter if doc in ordered[0])
+
+    result_docs = []
+    for doc in candidates:
+        if all(doc in docs for docs in ordered[1:]) and match_phrase(token_data, doc, slop):
+            result_docs.append(doc)
+            if len(result_docs) == top_k:
+                break
+    return result_docs
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    # Size-bounded LRU cache of search results. Each lookup names the index generation it
+    # searches: as soon as a newer generation shows up every older entry is dropped, and
+    # results computed on an older generation are never stored.
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_generation(self, generation):
+        # False when the caller works on an older generation than the cache holds
+        if self.generation is None or generation > self.generation:
+            if self._entries:
+                self.invalidations += 1
+                self._entries.clear()
+            self.generation = generation
+        return generation == self.generation
+
+    def get(self, generation, key):
+        with self._lock:
+            if not self._check_generation(generation) or key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, generation, key, value):
+        with self._lock:
+            if self.max_entries <= 0 or not self._check_generation(generation):
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,26 @@
-﻿import tkinter as tk
+﻿import os
+import queue
+import argparse
+import tkinter as tk
 from tkinter import ttk
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import indexing
+import shards
+import impact_index
+import instrumentation
+import term_dictionary
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Pause in typing after which the query is searched
+SEARCH_DELAY_MS = 300
+POLL_INTERVAL_MS = 30
+COMPLETION_COUNT = 8
+# Results turned into widgets at a time, "Show more" builds the next page
+PAGE_SIZE = 20
 
 class SearchEngineApp:
-    def __init__(self):
+    def __init__(self, engine):
+        self.engine = engine
         self.root = tk.Tk()
         self.root.title("Search Engine")
         self.root.geometry("700x500")
@@ -63,6 +79,18 @@ class SearchEngineApp:
         self.search_button.pack(side=tk.LEFT, padx=10)
         
         self.search_entry.bind("<Return>", lambda event: self.search())
+        self.search_entry.bind("<KeyRelease>", self.on_key_release)
+        self.search_entry.bind("<Down>", lambda event: self.focus_completions())
+        self.search_entry.bind("<Escape>", lambda event: self.hide_completions())
+
+        # Completions for the word being typed, shown under the search box
+        self.completion_list = tk.Listbox(self.root, font=("Arial", 12), relief=tk.SOLID, bd=1, activestyle="none")
+        self.completion_list.bind("<Return>", lambda event: self.use_completion())
+        self.completion_list.bind("<Double-Button-1>", lambda event: self.use_completion())
+        self.completion_list.bind("<Escape>", lambda event: (self.hide_completions(), self.search_entry.focus_set()))
+
+        self.status_label = tk.Label(self.root, text="", font=("Arial", 10), fg="#777", bg="#f4f4f4")
+        self.status_label.pack()
         
         self.results_frame = tk.Frame(self.root, bg="#f4f4f4")
         self.results_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
@@ -77,50 +105,54 @@ class SearchEngineApp:
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
         self.results_text.config(yscrollcommand=self.scrollbar.set)
+
+        # Searches run on one background thread so the window never freezes, a newer search
+        # supersedes the older ones (see start_search)
+        self.searcher = ThreadPoolExecutor(max_workers=1)
+        self.search_results = queue.Queue()
+        self.search_number = 0
+        self.pending_search = None
+        self.search_after_id = None
+        self.root.after(POLL_INTERVAL_MS, self.poll_search_results)
         
         self.root.mainloop()
+        self.searcher.shutdown(wait=False, cancel_futures=True)
     
 
-    def get_filtered_articles(self, doc_ids, time_range, top_k):
-        current_date = datetime.now()
-        
-        if time_range == "Last week":
-            start_date = current_date - timedelta(days=7)
-        elif time_range == "Last month":
-            start_date = current_date - timedelta(days=30)
-        elif time_range == "Last year":
-            start_date = current_date - timedelta(days=365)
-        else:
-            return doc_ids[:top_k]
-        filtered_articles = []
+    def search(self):
+        # Enter or the Search button: run the query right away
+        self.cancel_search_as_you_type()
+        self.hide_completions()
+        self.start_search(self.search_entry.get().strip())
 
-        for doc_id in doc_ids:
-            article = indexing.inverted_index['metadata'].get(doc_id)
-            if not article:
-                continue  
-            
-            # Extract the date string in the format "DD/MM/YYYY HH:MM GMT+X"
-            date_string = article.get('date', '').split(" ")[0] 
-            
-            try:
-                # date in the format "day/month/year"
-                article_date = datetime.strptime(date_string, "%d/%m/%Y")
-                if article_date >= start_date:
-                    filtered_articles.append(doc_id)
-            except ValueError:
-                print(f"Error parsing date for article {article.get('title')}")
-                continue
-        
-        return filtered_articles[:top_k]
+    def on_key_release(self, event):
+        # Search as you type: a search starts once typing has paused for SEARCH_DELAY_MS
+        if event.keysym in ("Return", "KP_Enter", "Escape", "Down", "Up", "Tab"):
+            return
+        self.cancel_search_as_you_type()
+        self.search_after_id = self.root.after(SEARCH_DELAY_MS, self.search_as_you_type)
 
+    def cancel_search_as_you_type(self):
+        if self.search_after_id is not None:
+            self.root.after_cancel(self.search_after_id)
+            self.search_after_id = None
 
-    def search(self):
-        query = self.search_entry.get().strip()
-        
-        for widget in self.results_frame.winfo_children():
-            widget.destroy()
+    def search_as_you_type(self):
+        self.search_after_id = None
+        self.start_search(self.search_entry.get().strip(), complete=True)
+
+    def start_search(self, query, complete=False):
+        # Every search gets a number, the results of a superseded search are never shown
+        self.search_number += 1
+        if self.pending_search is not None:
+            # Superseded searches that have not started yet are dropped
+            self.pending_search.cancel()
+            self.pending_search = None
 
         if not query:
+            self.hide_completions()
+            self.status_label.config(text="")
+            self.clear_results()
             empty_label = tk.Label(
                 self.results_frame,
                 text="Please enter a search query.",
@@ -131,26 +163,102 @@ class SearchEngineApp:
             empty_label.pack(pady=20)
             return
 
-        if query[0] == "\"" and query[-1] == "\"":
-            query = query.strip('"')
-            doc_ids = indexing.exact_match(query, indexing.inverted_index)
-        elif indexing.contain_logical_operator(query):
-            doc_ids = indexing.process_logical_operator(query, indexing.inverted_index)
-        else:
-            query_tokens = indexing.tokenize(query) # remove stop words and clean query
-            query = " ".join(query_tokens)
-            query_vector = indexing.query_to_vector(query, indexing.idf)
-            doc_ids = indexing.retrieve_documents(query_vector, indexing.vector_space)
-
         time_range = self.time_range_var.get()  
         top_k = self.top_k_var.get()
+        # The time range is pushed down into the search, only documents inside it are looked at
+        start = indexing.time_range_start(time_range)
 
-        filtered_doc_ids = self.get_filtered_articles(doc_ids, time_range, top_k)
-        self.display_results(filtered_doc_ids)
+        self.status_label.config(text="Searching...")
+        self.pending_search = self.searcher.submit(
+            self.run_search, self.search_number, query, top_k, start, complete
+        )
+
+    def run_search(self, number, query, top_k, start, complete):
+        # Runs on the search thread: no Tk calls here, results go back through a queue
+        if number != self.search_number:
+            return
+        completions = None
+        if complete and not query.endswith(" "):
+            # Completions for the word being typed
+            word = query.split()[-1].strip('"()')
+            completions = [] if term_dictionary.has_wildcard(word) else self.engine.complete(word, COMPLETION_COUNT)
+        try:
+            # Quoted phrase, boolean query or ranked search, repeated queries come from the result cache
+            doc_ids = self.engine.cached_search(query, top_k, start)
+            results = [(doc_id, self.engine.metadata(doc_id)) for doc_id in doc_ids]
+        except Exception as error:
+            results = error
+        self.search_results.put((number, results, completions))
+
+    def poll_search_results(self):
+        # Results are handed to Tk on the main thread, only those of the latest search are shown
+        try:
+            while True:
+                number, results, completions = self.search_results.get_nowait()
+                if number != self.search_number:
+                    continue
+                self.status_label.config(text="")
+                if completions is not None:
+                    self.show_completions(completions)
+                self.clear_results()
+                if isinstance(results, Exception):
+                    # ValueError: a malformed query, e.g. a boolean query ending in an operator
+                    reason = "Invalid query" if isinstance(results, ValueError) else "Search failed"
+                    error_label = tk.Label(
+                        self.results_frame,
+                        text=f"{reason}: {results}",
+                        font=("Arial", 14),
+                        fg="#555",
+                        bg="#f4f4f4",
+                    )
+                    error_label.pack(pady=20)
+                    continue
+                with instrumentation.stage("display_results"):
+                    self.display_results(results)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_INTERVAL_MS, self.poll_search_results)
+
+    def show_completions(self, completions):
+        self.completion_list.delete(0, tk.END)
+        for completion in completions:
+            self.completion_list.insert(tk.END, completion)
+        if completions:
+            self.completion_list.config(height=len(completions))
+            self.completion_list.place(in_=self.search_entry, x=0, rely=1.0, relwidth=1.0)
+            self.completion_list.lift()
+        else:
+            self.hide_completions()
 
+    def hide_completions(self):
+        self.completion_list.place_forget()
 
-    def display_results(self, doc_ids):
-        if not doc_ids:
+    def focus_completions(self):
+        if self.completion_list.winfo_ismapped():
+            self.completion_list.focus_set()
+            self.completion_list.selection_clear(0, tk.END)
+            self.completion_list.selection_set(0)
+            self.completion_list.activate(0)
+
+    def use_completion(self):
+        # Replaces the word being typed with the chosen completion and searches
+        selection = self.completion_list.curselection()
+        if not selection:
+            return
+        words = self.search_entry.get().split()
+        words[-1] = self.completion_list.get(selection[0])
+        self.search_entry.delete(0, tk.END)
+        self.search_entry.insert(0, " ".join(words))
+        self.search_entry.focus_set()
+        self.search()
+
+    def clear_results(self):
+        for widget in self.results_frame.winfo_children():
+            widget.destroy()
+
+    def display_results(self, results):
+        # results are (doc_id, metadata) pairs, widgets are only built PAGE_SIZE at a time
+        if not results:
             no_results_label = tk.Label(
                 self.results_frame,
                 text="No results found.",
@@ -179,44 +287,55 @@ class SearchEngineApp:
             canvas.yview_scroll(-1 * (event.delta // 120), "units")
             
         canvas.bind_all("<MouseWheel>", on_mousewheel)
-        
-        for doc_id in doc_ids:
-            metadata = indexing.inverted_index["metadata"].get(doc_id, {})
-            title = metadata.get("title", "No Title")
-            author = metadata.get("author", "Unknown Author")
-            date = metadata.get("date", "Unknown Date")
-            category = metadata.get("category", "Uncategorized")
-            
-            max_title_length = 50
-            if len(title) > max_title_length:
-                title = f"{title[:max_title_length].rsplit(' ', 1)[0]}..."
+
+        def show_page(first):
+            for doc_id, metadata in results[first:first + PAGE_SIZE]:
+                title = metadata.get("title", "No Title")
+                author = metadata.get("author", "Unknown Author")
+                date = metadata.get("date", "Unknown Date")
+                category = metadata.get("category", "Uncategorized")
                 
-            title_label = tk.Label(
-                scrollable_frame,
-                text=title,
-                font=("Arial", 14, "bold"),
-                fg="#1a73e8",  
-                cursor="hand2",
-                bg="#f4f4f4",
-                wraplength=600,
-                anchor="w",
-            )
-            title_label.pack(fill=tk.X, pady=5, padx=10)
-            title_label.bind("<Button-1>", lambda event, doc_id=doc_id: self.display_article(doc_id))
-            
-            details_label = tk.Label(
-                scrollable_frame,
-                text=f"Author: {author} | Date: {date} | Category: {category}",
-                font=("Arial", 10),
-                fg="#555",
-                bg="#f4f4f4",
-                anchor="w",
-            )
-            details_label.pack(fill=tk.X, padx=20)
-            
-            separator = tk.Frame(scrollable_frame, height=1, bg="#ddd")
-            separator.pack(fill=tk.X, pady=5, padx=10)
-            
+                max_title_length = 50
+                if len(title) > max_title_length:
+                    title = f"{title[:max_title_length].rsplit(' ', 1)[0]}..."
+                    
+                title_label = tk.Label(
+                    scrollable_frame,
+                    text=title,
+                    font=("Arial", 14, "bold"),
+                    fg="#1a73e8",  
+                    cursor="hand2",
+                    bg="#f4f4f4",
+                    wraplength=600,
+                    anchor="w",
+                )
+                title_label.pack(fill=tk.X, pady=5, padx=10)
+                title_label.bind("<Button-1>", lambda event, doc_id=doc_id: self.display_article(doc_id))
+                
+                details_label = tk.Label(
+                    scrollable_frame,
+                    text=f"Author: {author} | Date: {date} | Category: {category}",
+                    font=("Arial", 10),
+                    fg="#555",
+                    bg="#f4f4f4",
+                    anchor="w",
+                )
+                details_label.pack(fill=tk.X, padx=20)
+                
+                separator = tk.Frame(scrollable_frame, height=1, bg="#ddd")
+                separator.pack(fill=tk.X, pady=5, padx=10)
+
+            remaining = len(results) - first - PAGE_SIZE
+            if remaining > 0:
+                # The next page is only built when asked for
+                more_button = tk.Button(
+                    scrollable_frame, text=f"Show more ({remaining} left)", font=("Arial", 11),
+                    relief=tk.FLAT, bg="#f4f4f4", fg="#1a73e8", cursor="hand2",
+                    command=lambda: (more_button.destroy(), show_page(first + PAGE_SIZE)),
+                )
+                more_button.pack(pady=5)
+
+        show_page(0)
         canvas.yview_moveto(0)
         
     def display_article(self, doc_id):
@@ -228,8 +347,9 @@ class SearchEngineApp:
         article_window.configure(bg="#ffffff")
         article_window.resizable(False, True)
     
-        metadata = indexing.inverted_index["metadata"].get(doc_id, {})
-        content = metadata.get("content", "No content available")
+        metadata = self.engine.metadata(doc_id)
+        # Only the opened article's body is read from the document store
+        content = self.engine.content(doc_id) or "No content available"
     
         back_button = tk.Button(
             article_window,
@@ -320,4 +440,35 @@ class SearchEngineApp:
 
         
 if __name__ == "__main__":
-    app = SearchEngineApp()
+    parser = argparse.ArgumentParser(description="Search engine")
+    # Folder containing the article JSON files (data)
+    parser.add_argument("--data-dir", default=os.path.join(BASE_DIR, "data"))
+    # Binary index directory, created from the JSON index or the data folder when missing
+    parser.add_argument("--index-dir", default=os.path.join(BASE_DIR, "inverted_index"))
+    # JSON index imported on the first start, if present
+    parser.add_argument("--index-file", default=os.path.join(BASE_DIR, "inverted_index.json"))
+    # Ranking model: raw TF-IDF dot product, or cosine / BM25 impacts precomputed in the index
+    parser.add_argument("--scoring", choices=("tfidf",) + impact_index.MODELS, default="tfidf")
+    parser.add_argument("--impact-bits", type=int, choices=(8, 16), default=8)
+    # Only match query words as written, without unaccented or misspelled forms
+    parser.add_argument("--no-variants", action="store_true")
+    # Split the corpus into this many shards, each searched in its own process
+    parser.add_argument("--shards", type=int, default=0)
+    parser.add_argument("--shard-dir", default=os.path.join(BASE_DIR, "inverted_index_shards"))
+    # Per-stage timings, slow query log and sampling profiler, all off by default
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    if args.shards:
+        engine = shards.ShardedIndex(args.data_dir, args.shard_dir, args.shards, variants=not args.no_variants)
+    else:
+        engine = indexing.SearchIndex(
+            args.data_dir, args.index_dir, args.index_file, scoring=args.scoring, impact_bits=args.impact_bits,
+            variants=not args.no_variants
+        )
+    # The window opens right away while the index and TF-IDF vectors load in the background
+    engine.warm_up()
+    app = SearchEngineApp(engine)
+    # The window has been closed: stop the profiler and save the metrics
+    instrumentation.shutdown(args.metrics_file)
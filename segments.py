@@ -0,0 +1,345 @@
+﻿import os
+import sys
+import json
+import math
+import shutil
+import time
+import threading
+from collections import defaultdict
+from collections.abc import Mapping
+
+import indexing
+import binary_index
+
+MANIFEST_FILE = "manifest.json"
+
+
+class Segment:
+    # One immutable binary index, written once and never modified afterwards
+
+    def __init__(self, index_root, name):
+        self.name = name
+        self.index = binary_index.load_binary_index(os.path.join(index_root, name))
+
+    def __len__(self):
+        return len(self.index["metadata"])
+
+    def document_terms(self, doc_id):
+        return set(indexing.tokenize(self.index["documents"][doc_id]))
+
+
+class SnapshotPostings(Mapping):
+    # "tokens" view over every segment of a snapshot, hiding tombstoned documents
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, term):
+        docs = {}
+        for segment in self.snapshot.segments:
+            deleted = self.snapshot.tombstones[segment.name]
+            for doc_id, positions in segment.index["tokens"].get(term, {}).items():
+                if doc_id not in deleted:
+                    docs[doc_id] = positions
+        if not docs:
+            raise KeyError(term)
+        return docs
+
+    def __contains__(self, term):
+        return self.snapshot.doc_frequencies.get(term, 0) > 0
+
+    def __iter__(self):
+        return (term for term, df in sorted(self.snapshot.doc_frequencies.items()) if df > 0)
+
+    def __len__(self):
+        return sum(1 for df in self.snapshot.doc_frequencies.values() if df > 0)
+
+    def document_frequencies(self):
+        # Live counts kept up to date by every commit, no postings are merged to get them
+        for term in self:
+            yield term, self.snapshot.doc_frequencies[term]
+
+    def document_frequency(self, term):
+        return self.snapshot.doc_frequencies.get(term, 0)
+
+    def max_term_frequency(self, term):
+        # Upper bound only, a tombstoned document may have held the maximum
+        return max((segment.index["tokens"].max_term_frequency(term) for segment in self.snapshot.segments), default=0)
+
+
+class SnapshotMapping(Mapping):
+    # Per-document view ("metadata" or "documents") routed to the segment holding the live copy
+
+    def __init__(self, snapshot, part):
+        self.snapshot = snapshot
+        self.part = part
+
+    def __getitem__(self, doc_id):
+        return self.snapshot.locations[doc_id].index[self.part][doc_id]
+
+    def __contains__(self, doc_id):
+        return doc_id in self.snapshot.locations
+
+    def __iter__(self):
+        return iter(self.snapshot.locations)
+
+    def __len__(self):
+        return len(self.snapshot.locations)
+
+
+class Snapshot:
+    # Immutable view of the index at one generation. Queries keep using the snapshot they
+    # started with while updates and merges publish new ones.
+
+    def __init__(self, generation, segments, tombstones, doc_frequencies):
+        self.generation = generation
+        self.segments = tuple(segments)
+        self.tombstones = tombstones
+        self.doc_frequencies = doc_frequencies
+        self.tokens = SnapshotPostings(self)
+        self.metadata = SnapshotMapping(self, "metadata")
+        self.documents = SnapshotMapping(self, "documents")
+
+        self.locations = {}
+        for segment in self.segments:
+            deleted = tombstones[segment.name]
+            for doc_id in segment.index["metadata"]:
+                if doc_id not in deleted:
+                    self.locations[doc_id] = segment
+
+    def as_index(self):
+        return {"tokens": self.tokens, "metadata": self.metadata, "documents": self.documents}
+
+
+class SegmentedIndex:
+    def __init__(self, index_root, merge_factor=4, background_merge=True):
+        self.index_root = index_root
+        self.merge_factor = merge_factor
+        self._lock = threading.Lock()
+        self._name_lock = threading.Lock()
+        self._merge_wanted = threading.Event()
+        self._closed = False
+
+        os.makedirs(index_root, exist_ok=True)
+        manifest_path = os.path.join(index_root, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        else:
+            manifest = {"generation": 0, "next_segment": 0, "segments": [], "tombstones": {}, "files": {}}
+
+        self.next_segment = manifest["next_segment"]
+        self.files = manifest["files"]
+        segments = [Segment(index_root, name) for name in manifest["segments"]]
+        tombstones = {
+            segment.name: frozenset(manifest["tombstones"].get(segment.name, ()))
+            for segment in segments
+        }
+
+        doc_frequencies = defaultdict(int)
+        for segment in segments:
+            for term, df in segment.index["tokens"].document_frequencies():
+                doc_frequencies[term] += df
+            for doc_id in tombstones[segment.name]:
+                for term in segment.document_terms(doc_id):
+                    doc_frequencies[term] -= 1
+
+        self._snapshot = Snapshot(manifest["generation"], segments, tombstones, dict(doc_frequencies))
+        self._remove_unused_segments()
+
+        self._merge_thread = None
+        if background_merge:
+            self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+            self._merge_thread.start()
+            self._merge_wanted.set()
+
+    def snapshot(self):
+        return self._snapshot
+
+    def update(self, folder_path):
+        # Index new and changed files from folder_path and tombstone the ones that disappeared
+        with self._lock:
+            snapshot = self._snapshot
+            files = dict(self.files)
+            new_index = {"tokens": defaultdict(dict), "metadata": {}}
+            deleted = set()
+
+            current_files = set()
+            for file_name in sorted(os.listdir(folder_path)):
+                if not file_name.endswith(".json"):
+                    continue
+                current_files.add(file_name)
+                file_path = os.path.join(folder_path, file_name)
+                stat = os.stat(file_path)
+                known = files.get(file_name)
+                if known and known["mtime"] == stat.st_mtime_ns and known["size"] == stat.st_size:
+                    continue
+
+                if known:
+                    deleted.add(known["post_id"])
+                post_id = indexing.add_article(new_index, indexing.read_article(file_path))
+                # A re-ingested post replaces the copy held by an older segment
+                deleted.add(post_id)
+                files[file_name] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "post_id": post_id}
+
+            for file_name in set(files) - current_files:
+                deleted.add(files.pop(file_name)["post_id"])
+
+            if not new_index["metadata"] and not deleted:
+                return snapshot
+
+            self.files = files
+            snapshot = self._commit(snapshot, new_index, deleted)
+
+        self._merge_wanted.set()
+        return snapshot
+
+    def delete_documents(self, post_ids):
+        with self._lock:
+            return self._commit(self._snapshot, None, set(post_ids))
+
+    def _commit(self, snapshot, new_index, deleted):
+        segments = list(snapshot.segments)
+        tombstones = dict(snapshot.tombstones)
+        doc_frequencies = dict(snapshot.doc_frequencies)
+
+        for doc_id in deleted:
+            segment = snapshot.locations.get(doc_id)
+            if segment is None:
+                continue
+            tombstones[segment.name] = tombstones[segment.name] | {doc_id}
+            for term in segment.document_terms(doc_id):
+                doc_frequencies[term] -= 1
+
+        if new_index and new_index["metadata"]:
+            segment = self._write_segment(new_index)
+            segments.append(segment)
+            tombstones[segment.name] = frozenset()
+            for term, df in segment.index["tokens"].document_frequencies():
+                doc_frequencies[term] = doc_frequencies.get(term, 0) + df
+
+        return self._publish(Snapshot(snapshot.generation + 1, segments, tombstones, doc_frequencies))
+
+    def _write_segment(self, inverted_index):
+        with self._name_lock:
+            name = f"segment_{self.next_segment:06d}"
+            self.next_segment += 1
+        binary_index.write_binary_index(inverted_index, os.path.join(self.index_root, name))
+        return Segment(self.index_root, name)
+
+    def _publish(self, snapshot):
+        manifest = {
+            "generation": snapshot.generation,
+            "next_segment": self.next_segment,
+            "segments": [segment.name for segment in snapshot.segments],
+            "tombstones": {name: sorted(docs) for name, docs in snapshot.tombstones.items() if docs},
+            "files": self.files,
+        }
+        manifest_path = os.path.join(self.index_root, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        self._snapshot = snapshot
+        return snapshot
+
+    def _pick_merge(self, snapshot):
+        # Tiered policy: segments are grouped by size on a log scale and merge_factor
+        # segments of the same tier are merged into one
+        tiers = defaultdict(list)
+        for segment in snapshot.segments:
+            live = len(segment) - len(snapshot.tombstones[segment.name])
+            tier = int(math.log(max(live, 1), self.merge_factor))
+            tiers[tier].append(segment)
+
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= self.merge_factor:
+                return tiers[tier][:self.merge_factor]
+        return None
+
+    def merge(self):
+        # Run one merge step, returns False when the policy has nothing to merge
+        snapshot = self._snapshot
+        merging = self._pick_merge(snapshot)
+        if not merging:
+            return False
+
+        merged_index = {"tokens": defaultdict(dict), "metadata": {}, "documents": {}}
+        for segment in merging:
+            deleted = snapshot.tombstones[segment.name]
+            for doc_id, metadata in segment.index["metadata"].items():
+                if doc_id not in deleted:
+                    merged_index["metadata"][doc_id] = metadata
+                    merged_index["documents"][doc_id] = segment.index["documents"][doc_id]
+            for term, docs in segment.index["tokens"].items():
+                for doc_id, positions in docs.items():
+                    if doc_id not in deleted:
+                        merged_index["tokens"][term][doc_id] = positions
+        merged = self._write_segment(merged_index)
+
+        with self._lock:
+            current = self._snapshot
+            merged_names = {segment.name for segment in merging}
+            segments = []
+            for segment in current.segments:
+                if segment.name == merging[0].name:
+                    segments.append(merged)
+                elif segment.name not in merged_names:
+                    segments.append(segment)
+
+            tombstones = {name: docs for name, docs in current.tombstones.items() if name not in merged_names}
+            # Documents deleted while the merge was running stay deleted in the merged segment
+            tombstones[merged.name] = frozenset(
+                doc_id for segment in merging
+                for doc_id in current.tombstones[segment.name] - snapshot.tombstones[segment.name]
+            )
+            self._publish(Snapshot(current.generation + 1, segments, tombstones, current.doc_frequencies))
+            self._remove_unused_segments()
+
+        return True
+
+    def _merge_loop(self):
+        while not self._closed:
+            self._merge_wanted.wait()
+            self._merge_wanted.clear()
+            if self._closed:
+                break
+            while not self._closed and self.merge():
+                pass
+
+    def _remove_unused_segments(self):
+        # Old segments may still be memory-mapped by running queries, files that cannot be
+        # removed yet are retried after the next merge
+        used = {segment.name for segment in self._snapshot.segments}
+        for name in os.listdir(self.index_root):
+            if name.startswith("segment_") and name not in used:
+                shutil.rmtree(os.path.join(self.index_root, name), ignore_errors=True)
+
+    def wait_for_merges(self):
+        if self._merge_thread is None:
+            while self.merge():
+                pass
+            return
+        while self._pick_merge(self._snapshot):
+            self._merge_wanted.set()
+            time.sleep(0.05)
+
+    def close(self):
+        self._closed = True
+        self._merge_wanted.set()
+        if self._merge_thread:
+            self._merge_thread.join()
+
+
+if __name__ == "__main__":
+    # python segments.py <data folder> <index folder>
+    if len(sys.argv) != 3:
+        print("Usage: python segments.py <folder_path> <index_root>")
+        sys.exit(1)
+
+    segmented_index = SegmentedIndex(sys.argv[2])
+    snapshot = segmented_index.update(sys.argv[1])
+    segmented_index.wait_for_merges()
+    segmented_index.close()
+    snapshot = segmented_index.snapshot()
+    print(f"Generation {snapshot.generation}: {len(snapshot.metadata)} documents in {len(snapshot.segments)} segments.")
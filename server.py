@@ -0,0 +1,382 @@
+﻿import os
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import indexing
+import shards
+import impact_index
+import instrumentation
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ("auto", "phrase", "boolean", "ranked")
+MAX_BODY_SIZE = 1 << 20
+
+# Engine of the current worker process (or of the server process for the thread executor)
+engine = None
+# Worker processes send the metrics they recorded back with every batch
+report_metrics = False
+
+
+def init_worker(folder_path, index_dir, index_file, cache_size=1024, scoring="tfidf", impact_bits=8,
+                variants=True, metrics_settings=None):
+    global engine, report_metrics
+    if metrics_settings is not None:
+        # Process workers: instrumentation state is per process, one profile file per worker.
+        # A forked worker starts from a copy of the server's state, which is not its own.
+        instrumentation.profiler = None
+        instrumentation.metrics.reset()
+        settings = dict(metrics_settings)
+        if settings.get("profile"):
+            settings["profile"] = f"{settings['profile']}.{os.getpid()}"
+        instrumentation.configure(**settings)
+        report_metrics = True
+    engine = indexing.SearchIndex(
+        folder_path, index_dir, index_file, cache_size=cache_size, scoring=scoring, impact_bits=impact_bits,
+        variants=variants
+    )
+    engine.warm_up(background=False)
+
+
+def execute(request):
+    # One search with the same modes SearchEngineApp.search dispatches to
+    query = request["query"]
+    mode = request.get("mode", "auto")
+    top_k = request.get("top_k")
+
+    start = request.get("start")
+    if request.get("time_range"):
+        start = indexing.time_range_start(request["time_range"])
+    doc_ids = engine.cached_search(query, top_k, start, request.get("end"), mode)
+
+    results = []
+    for doc_id in doc_ids:
+        metadata = engine.metadata(doc_id)
+        results.append({
+            "doc_id": doc_id,
+            "title": metadata.get("title"),
+            "author": metadata.get("author"),
+            "date": metadata.get("date"),
+            "category": metadata.get("category"),
+        })
+    return {"query": query, "mode": mode, "results": results}
+
+
+def execute_batch(requests):
+    # Runs in a worker, several requests per task keeps the inter-process overhead down
+    responses = []
+    for request in requests:
+        start = time.perf_counter()
+        try:
+            response = execute(request)
+        except ValueError as error:
+            # Malformed query, e.g. a boolean query ending in an operator
+            response = {"query": request.get("query"), "error": str(error), "status": 400}
+        except Exception as error:
+            response = {"query": request.get("query"), "error": str(error), "status": 500}
+        response["took_ms"] = (time.perf_counter() - start) * 1000
+        responses.append(response)
+    return responses, instrumentation.metrics.drain() if report_metrics else None
+
+
+def complete(prefix, limit):
+    return {"prefix": prefix, "completions": engine.complete(prefix, limit)}
+
+
+def worker_stats():
+    return {"pid": os.getpid(), "generation": engine.generation, "cache": engine.cache_stats()}
+
+
+def validate(request):
+    if not isinstance(request, dict) or not isinstance(request.get("query"), str) or not request["query"].strip():
+        raise ValueError("'query' must be a non-empty string")
+    if request.get("mode", "auto") not in MODES:
+        raise ValueError(f"'mode' must be one of {', '.join(MODES)}")
+    top_k = request.get("top_k")
+    if top_k is not None and (not isinstance(top_k, int) or top_k < 1):
+        raise ValueError("'top_k' must be a positive integer")
+    for name in ("start", "end"):
+        value = request.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"'{name}' must be a timestamp or null")
+    time_range = request.get("time_range")
+    if time_range not in (None, "Default") and time_range not in indexing.TIME_RANGES:
+        raise ValueError(f"'time_range' must be Default or one of {', '.join(indexing.TIME_RANGES)}")
+    return request
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Batcher:
+    # Queues incoming searches and hands them to the worker pool in batches. The queue is
+    # bounded: once max_pending searches wait, new ones are rejected (HTTP 503) instead of
+    # piling up latency.
+
+    def __init__(self, executor, concurrency, max_batch_size=16, max_wait=0.002, max_pending=1024):
+        self.executor = executor
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def submit(self, requests):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for request in requests:
+            future = loop.create_future()
+            try:
+                self.queue.put_nowait((request, future))
+            except asyncio.QueueFull:
+                for queued in futures:
+                    queued.cancel()
+                raise Overloaded()
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(request, future) for request, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            try:
+                responses, worker_metrics = await loop.run_in_executor(
+                    self.executor, execute_batch, [request for request, _ in batch]
+                )
+                if worker_metrics is not None:
+                    instrumentation.metrics.merge(worker_metrics)
+            except Exception as error:
+                responses = [
+                    {"query": request.get("query"), "error": str(error), "status": 500} for request, _ in batch
+                ]
+            for (_, future), response in zip(batch, responses):
+                if not future.cancelled():
+                    future.set_result(response)
+
+
+class SearchServer:
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    await self.respond(writer, 413, {"error": "request body too large"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, payload = await self.route(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close" and version.strip() == "HTTP/1.1"
+                await self.respond(writer, status, payload, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        try:
+            if url.path == "/health":
+                return 200, {"status": "ok", "pending": self.batcher.queue.qsize()}
+
+            if url.path == "/stats":
+                # Cache counters of whichever worker picks the call up
+                loop = asyncio.get_running_loop()
+                return 200, await loop.run_in_executor(self.batcher.executor, worker_stats)
+
+            if url.path == "/complete" and method == "GET":
+                # Most frequent index terms starting with q, for search-as-you-type
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                limit = int(params.get("limit", 10))
+                if limit < 1:
+                    raise ValueError("'limit' must be a positive integer")
+                loop = asyncio.get_running_loop()
+                return 200, await loop.run_in_executor(self.batcher.executor, complete, params.get("q", ""), limit)
+
+            if url.path == "/metrics":
+                # Stage timings and counters of every worker in the Prometheus text format
+                if url.query == "format=json":
+                    return 200, instrumentation.metrics.snapshot()
+                return 200, instrumentation.metrics.prometheus()
+
+            if url.path == "/search" and method == "GET":
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                request = {"query": params.get("q", ""), "mode": params.get("mode", "auto")}
+                for name in ("top_k",):
+                    if name in params:
+                        request[name] = int(params[name])
+                for name in ("start", "end"):
+                    if name in params:
+                        request[name] = float(params[name])
+                if "time_range" in params:
+                    request["time_range"] = params["time_range"]
+                responses = await self.batcher.submit([validate(request)])
+                return responses[0].pop("status", 200), responses[0]
+
+            if url.path == "/search" and method == "POST":
+                responses = await self.batcher.submit([validate(json.loads(body))])
+                return responses[0].pop("status", 200), responses[0]
+
+            if url.path == "/batch" and method == "POST":
+                requests = json.loads(body).get("queries", [])
+                responses = await self.batcher.submit([validate(request) for request in requests])
+                return 200, {"responses": responses}
+
+            return 404, {"error": f"no route for {method} {url.path}"}
+        except Overloaded:
+            return 503, {"error": "server overloaded, retry later"}
+        except (ValueError, AttributeError) as error:
+            return 400, {"error": str(error)}
+
+    async def respond(self, writer, status, payload, close=False):
+        reasons = {
+            200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+            500: "Internal Server Error", 503: "Service Unavailable",
+        }
+        if isinstance(payload, str):
+            body = payload.encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        headers = [
+            f"HTTP/1.1 {status} {reasons.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'close' if close else 'keep-alive'}",
+        ]
+        if status == 503:
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+async def serve(args):
+    global engine
+    if args.shards:
+        # The shards already run in their own processes, the coordinator only waits on them
+        engine = shards.ShardedIndex(
+            args.data_dir, args.shard_dir, args.shards, cache_size=args.cache_size, variants=not args.no_variants
+        )
+        engine.warm_up(background=False)
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+    elif args.executor == "thread":
+        # One shared engine, searches still leave the event loop but share the GIL
+        init_worker(args.data_dir, args.index_dir, args.index_file, args.cache_size, args.scoring, args.impact_bits,
+                    not args.no_variants)
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+    else:
+        # Prepare the index (impacts, variants) once so the workers only have to open them
+        prepared = indexing.SearchIndex(
+            args.data_dir, args.index_dir, args.index_file, scoring=args.scoring, impact_bits=args.impact_bits,
+            variants=not args.no_variants
+        )
+        if args.scoring == "tfidf":
+            prepared.inverted_index
+        else:
+            prepared.impacts()
+        prepared.variants()
+        del prepared
+        metrics_settings = None
+        if instrumentation.enabled:
+            metrics_settings = {
+                "slow_query_ms": args.slow_query_ms, "slow_log": args.slow_query_log, "profile": args.profile
+            }
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers, initializer=init_worker,
+            initargs=(args.data_dir, args.index_dir, args.index_file, args.cache_size, args.scoring, args.impact_bits,
+                      not args.no_variants, metrics_settings)
+        )
+        # Start every worker before accepting connections
+        await asyncio.gather(*[
+            asyncio.get_running_loop().run_in_executor(executor, execute_batch, [])
+            for _ in range(args.workers)
+        ])
+
+    batcher = Batcher(executor, args.workers, args.batch_size, args.batch_wait / 1000, args.max_pending)
+    batcher.start()
+    server = SearchServer(batcher)
+    listener = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    workers = f"{args.workers} threads over {args.shards} shards" if args.shards else f"{args.workers} {args.executor} workers"
+    print(f"Serving on http://{args.host}:{args.port} with {workers}")
+
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await batcher.stop()
+        executor.shutdown(cancel_futures=True)
+        if args.shards:
+            engine.close()
+        instrumentation.shutdown(args.metrics_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP/JSON search server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--data-dir", default=os.path.join(BASE_DIR, "data"))
+    parser.add_argument("--index-dir", default=os.path.join(BASE_DIR, "inverted_index"))
+    parser.add_argument("--index-file", default=os.path.join(BASE_DIR, "inverted_index.json"))
+    parser.add_argument("--scoring", choices=("tfidf",) + impact_index.MODELS, default="tfidf")
+    parser.add_argument("--impact-bits", type=int, choices=(8, 16), default=8)
+    parser.add_argument("--no-variants", action="store_true", help="only match query words as written")
+    parser.add_argument("--shards", type=int, default=0, help="split the corpus into this many shard processes")
+    parser.add_argument("--shard-dir", default=os.path.join(BASE_DIR, "inverted_index_shards"))
+    parser.add_argument("--executor", choices=("process", "thread"), default="process")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=16, help="searches per worker task")
+    parser.add_argument("--batch-wait", type=float, default=2.0, help="ms to wait for a batch to fill")
+    parser.add_argument("--cache-size", type=int, default=1024, help="cached results per worker, 0 disables the cache")
+    parser.add_argument("--max-pending", type=int, default=1024, help="queued searches before answering 503")
+    # Per-stage timings served on /metrics, slow query log and sampling profiler, all off by default
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.configure_from_args(args)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
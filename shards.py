@@ -0,0 +1,323 @@
+﻿import os
+import sys
+import json
+import heapq
+import shutil
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import indexing
+import query_cache
+import binary_index
+import variant_index
+import instrumentation
+import term_dictionary
+
+MANIFEST_FILE = "shards.json"
+
+# Shard of the current worker process
+shard = None
+
+
+def build_shard(folder_path, file_names, shard_dir):
+    # Same tokenization and layout as create_binary_index, over one slice of the corpus
+    binary_index.write_binary_index(indexing.index_files(folder_path, file_names), shard_dir)
+    return len(file_names)
+
+
+def build_shards(folder_path, shard_root, shard_count, workers=None):
+    # Contiguous slices of the sorted file list: concatenating the shards in order gives the
+    # doc order of the unsharded index, which is the result order of unfiltered phrase and
+    # boolean queries
+    file_names = sorted(name for name in os.listdir(folder_path) if name.endswith(".json"))
+    shard_count = max(1, min(shard_count, len(file_names)))
+    chunk_size = -(-len(file_names) // shard_count)
+    chunks = [file_names[i:i + chunk_size] for i in range(0, len(file_names), chunk_size)]
+    names = [f"shard-{number:03d}" for number in range(len(chunks))]
+
+    if os.path.exists(shard_root):
+        shutil.rmtree(shard_root)
+    os.makedirs(shard_root)
+    shard_dirs = [os.path.join(shard_root, name) for name in names]
+    with ProcessPoolExecutor(max_workers=workers or len(chunks)) as executor:
+        list(executor.map(build_shard, [folder_path] * len(chunks), chunks, shard_dirs))
+
+    with open(os.path.join(shard_root, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump({"shards": names}, f, ensure_ascii=False, indent=4)
+    return names
+
+
+class Shard:
+    # Worker side: one shard's index, scored with the collection-wide statistics that the
+    # coordinator hands over in prepare()
+
+    def __init__(self, shard_dir):
+        self.index = binary_index.load_binary_index(shard_dir)
+        self.date_index = indexing.build_date_index(self.index["metadata"])
+        self.vector_space = None
+        self.upper_bounds = None
+
+    def statistics(self):
+        return list(self.index["metadata"]), self.date_index, dict(self.index["tokens"].document_frequencies())
+
+    def prepare(self, doc_frequencies, document_count):
+        self.vector_space, idf = indexing.compute_tfidf_vector_space(self.index, doc_frequencies, document_count)
+        local_idf = {term: idf[term] for term, _ in self.index["tokens"].document_frequencies()}
+        self.upper_bounds = indexing.compute_term_upper_bounds(self.index, local_idf)
+
+    def time_window(self, start, end):
+        if start is None and end is None:
+            return None
+        return indexing.docs_in_range(self.date_index, start, end)
+
+    def ranked(self, query_vector, top_k, start, end):
+        # (score, doc_id) of the shard's best documents, scored like retrieve_documents.
+        # Terms of other shards only (wildcard words, spelling variants) score nothing here.
+        query_vector = {term: weight for term, weight in query_vector.items() if term in self.upper_bounds}
+        doc_ids = indexing.retrieve_documents(
+            query_vector, self.vector_space, self.index, top_k, self.upper_bounds, self.time_window(start, end)
+        )
+        results = []
+        for doc_id in doc_ids:
+            doc_vector = self.vector_space[doc_id]
+            results.append((sum(query_vector[term] * doc_vector[term] for term in query_vector if term in doc_vector), doc_id))
+        return results
+
+    def matching(self, query, mode, top_k, start, end, expansions=None):
+        # Phrase or boolean matches in the shard's result order, with the article timestamp
+        # when a time range is given, since those come newest first. Phrase matches come in
+        # two tiers, exact ones and those only matching through spelling variants; the
+        # variants of each query word are looked up by the coordinator (expansions).
+        doc_filter = self.time_window(start, end)
+        variants = None if expansions is None else expansions.get
+        if mode == "phrase":
+            phrase_text, slop = indexing.parse_phrase_query(query) or (query, 0)
+            doc_ids = indexing.exact_match(phrase_text, self.index, doc_filter, top_k, slop)
+            tiers = [doc_ids, []]
+            if variants is not None and (top_k is None or len(doc_ids) < top_k):
+                remaining = None if top_k is None else top_k - len(doc_ids)
+                tiers[1] = indexing.variant_phrase_match(
+                    phrase_text, self.index, doc_filter, remaining, slop, variants, doc_ids
+                )
+        else:
+            tiers = [indexing.process_logical_operator(query, self.index, doc_filter, top_k, variants)]
+        if doc_filter is None:
+            return tiers
+        metadata = self.index["metadata"]
+        return [[(metadata[doc_id]["timestamp"], doc_id) for doc_id in doc_ids] for doc_ids in tiers]
+
+    def metadata(self, doc_id):
+        return self.index["metadata"].get(doc_id, {})
+
+    def content(self, doc_id):
+        return indexing.get_article_content(self.index, doc_id)
+
+
+def init_shard(shard_dir):
+    global shard
+    shard = Shard(shard_dir)
+
+
+def call_shard(method, *args):
+    return getattr(shard, method)(*args)
+
+
+class ShardedIndex:
+    # Coordinator over doc-partitioned shards, each served by its own worker process.
+    # Document frequencies are summed over all shards, so IDF and every score are the same
+    # as with one index. Queries are sent to every shard and the per-shard top k merged.
+    # cached_search, complete, metadata and content match indexing.SearchIndex; the uncached
+    # search_range takes a date range where SearchIndex.search takes a doc filter. Spelling
+    # variants are looked up in the collection-wide vocabulary here and sent along with the query.
+
+    def __init__(self, folder_path, shard_root, shard_count=None, workers=None, cache_size=1024, variants=True):
+        self.folder_path = folder_path
+        self.shard_root = shard_root
+        self.shard_count = shard_count or os.cpu_count() or 1
+        self.workers = workers
+        self.use_variants = variants
+        self.generation = 0
+        self.result_cache = query_cache.QueryCache(cache_size)
+        self._lock = threading.RLock()
+        self._executors = None
+        self._idf = None
+        self._terms = None
+        self._variants = None
+        self._doc_ids = None
+        self._doc_numbers = None
+        self._doc_shards = None
+        self._date_index = None
+        self._warm_up_thread = None
+
+    def _start(self):
+        manifest_path = os.path.join(self.shard_root, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            print(f"Sharded index '{self.shard_root}' already exists. Loading shards...")
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                names = json.load(f)["shards"]
+        else:
+            print(f"Sharded index '{self.shard_root}' not found. Building {self.shard_count} shards...")
+            names = build_shards(self.folder_path, self.shard_root, self.shard_count, self.workers)
+
+        # One single-process pool per shard pins each shard to its own process
+        executors = [
+            ProcessPoolExecutor(max_workers=1, initializer=init_shard, initargs=(os.path.join(self.shard_root, name),))
+            for name in names
+        ]
+        statistics = [future.result() for future in [executor.submit(call_shard, "statistics") for executor in executors]]
+
+        doc_ids = []
+        doc_shards = array("H")
+        dated_docs = []
+        doc_frequencies = {}
+        for number, (shard_doc_ids, date_index, shard_frequencies) in enumerate(statistics):
+            doc_ids.extend(shard_doc_ids)
+            doc_shards.extend([number] * len(shard_doc_ids))
+            dated_docs.extend(zip(date_index["timestamps"], date_index["doc_ids"]))
+            for term, df in shard_frequencies.items():
+                doc_frequencies[term] = doc_frequencies.get(term, 0) + df
+        dated_docs.sort()
+
+        for future in [executor.submit(call_shard, "prepare", doc_frequencies, len(doc_ids)) for executor in executors]:
+            future.result()
+
+        self._idf = indexing.compute_idf(doc_frequencies, len(doc_ids))
+        # Vocabulary of the whole collection, wildcard words expand the same as on one index
+        self._terms = term_dictionary.TermDictionary.from_frequencies(doc_frequencies)
+        self._doc_ids = doc_ids
+        self._doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        self._doc_shards = doc_shards
+        # Only used to key cached time ranges, the shards filter with their own date index
+        self._date_index = {
+            "timestamps": [timestamp for timestamp, _ in dated_docs],
+            "doc_ids": [doc_id for _, doc_id in dated_docs],
+        }
+        self._executors = executors
+
+    def executors(self):
+        if self._executors is None:
+            with self._lock:
+                if self._executors is None:
+                    self._start()
+        return self._executors
+
+    def variants(self):
+        # Built from the summed document frequencies, so variants are the same as on one index
+        if not self.use_variants:
+            return None
+        if self._variants is None:
+            self.executors()
+            with self._lock:
+                if self._variants is None:
+                    terms = self._terms
+                    with instrumentation.stage("load.variants"):
+                        self._variants = variant_index.VariantIndex.from_frequencies(
+                            dict(zip(terms.terms, terms.document_frequencies))
+                        )
+        return self._variants
+
+    def warm_up(self, background=True):
+        def load_all():
+            self.executors()
+            self.variants()
+
+        if not background:
+            load_all()
+        elif self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=load_all, daemon=True)
+            self._warm_up_thread.start()
+
+    def close(self):
+        with self._lock:
+            for executor in self._executors or []:
+                executor.shutdown()
+            self._executors = None
+
+    def _scatter(self, method, *args):
+        futures = [executor.submit(call_shard, method, *args) for executor in self.executors()]
+        return [future.result() for future in futures]
+
+    def _call(self, doc_id, method, default=None):
+        if doc_id not in self._doc_numbers:
+            return default
+        executor = self.executors()[self._doc_shards[self._doc_numbers[doc_id]]]
+        return executor.submit(call_shard, method, doc_id).result()
+
+    def search_range(self, query, top_k=None, start=None, end=None, mode="auto"):
+        mode = indexing.query_mode(query) if mode == "auto" else mode
+        self.executors()
+
+        if mode == "ranked":
+            with instrumentation.stage("tokenize"):
+                query_tokens, patterns = indexing.split_wildcards(query)
+            if patterns:
+                with instrumentation.stage("expand_wildcards"):
+                    query_tokens = indexing.expand_wildcards(query_tokens, patterns, self._terms)
+            variants = self.variants()
+            with instrumentation.stage("query_to_vector"):
+                query_vector = indexing.query_to_vector(" ".join(query_tokens), self._idf, variants)
+            # Time spent in the shard processes, including the wait for the slowest one
+            with instrumentation.stage("scatter_gather"):
+                shard_results = self._scatter("ranked", query_vector, top_k, start, end)
+            results = heapq.merge(*shard_results, key=lambda x: (-x[0], x[1]))
+            return [doc_id for _, doc_id in results][:top_k]
+
+        expansions = None
+        variants = self.variants()
+        if variants is not None:
+            with instrumentation.stage("expand_variants"):
+                words = indexing.query_words(query, mode, self._terms)
+                expansions = {word: variants.expand(word) for word in words}
+        with instrumentation.stage("scatter_gather"):
+            shard_results = self._scatter("matching", query, mode, top_k, start, end, expansions)
+        results = []
+        for tier in zip(*shard_results):
+            if start is None and end is None:
+                # Shards hold consecutive documents, their results follow each other in doc order
+                results.extend(doc_id for doc_ids in tier for doc_id in doc_ids)
+            else:
+                # Newest first, as the unsharded time window orders them
+                results.extend(doc_id for _, doc_id in heapq.merge(*tier, reverse=True))
+        return results[:top_k]
+
+    def cached_search(self, query, top_k=None, start=None, end=None, mode="auto"):
+        # Shards never change, the cache is keyed like SearchIndex.cached_search
+        self.executors()
+        mode = indexing.query_mode(query) if mode == "auto" else mode
+        with instrumentation.query(query, mode=mode, top_k=top_k, start=start, end=end):
+            window = None
+            if start is not None or end is not None:
+                with instrumentation.stage("date_filter"):
+                    window = indexing.date_range_bounds(self._date_index, start, end)
+            key = (mode, indexing.normalize_query(query, mode), window, top_k)
+            numbers = self.result_cache.get(self.generation, key)
+            if numbers is not None:
+                instrumentation.count("cache_hits")
+                return [self._doc_ids[number] for number in numbers]
+
+            results = self.search_range(query, top_k, start, end, mode)
+            self.result_cache.put(self.generation, key, array("I", [self._doc_numbers[doc_id] for doc_id in results]))
+            return results
+
+    def complete(self, prefix, limit=10):
+        self.executors()
+        return self._terms.complete(prefix.lower(), limit)
+
+    def cache_stats(self):
+        return {"results": self.result_cache.stats()}
+
+    def metadata(self, doc_id):
+        return self._call(doc_id, "metadata", {})
+
+    def content(self, doc_id):
+        return self._call(doc_id, "content")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python shards.py FOLDER SHARD_ROOT SHARD_COUNT")
+        sys.exit(1)
+
+    names = build_shards(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    print(f"Built {len(names)} shards in '{sys.argv[2]}'.")
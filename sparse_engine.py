@@ -0,0 +1,112 @@
+﻿import math
+
+import numpy as np
+
+import indexing
+
+
+class SparseEngine:
+    # TF-IDF space as a term-major sparse matrix (CSR of the term x document matrix, i.e. the
+    # CSC form of the document vectors). Row t holds the doc ids and weights of term t, so a
+    # batch of queries is scored with one sparse x sparse product.
+
+    def __init__(self, doc_ids, terms, idf, indptr, indices, data):
+        self.doc_ids = doc_ids
+        self.terms = terms
+        self.term_ids = {term: number for number, term in enumerate(terms)}
+        self.idf = idf
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @classmethod
+    def from_index(cls, inverted_index, idf):
+        # Doc ids are numbered in sorted order so the doc number doubles as the tie-breaker
+        doc_ids = sorted(inverted_index["metadata"])
+        doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+        terms = sorted(idf)
+
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indices = []
+        data = []
+        for number, term in enumerate(terms):
+            docs = inverted_index["tokens"][term]
+            for doc_id in sorted(docs, key=doc_numbers.__getitem__):
+                indices.append(doc_numbers[doc_id])
+                # Same formula as compute_tfidf_vector_space so scores match the dict engine
+                data.append((1 + math.log(len(docs[doc_id]))) * idf[term])
+            indptr[number + 1] = len(indices)
+
+        return cls(
+            doc_ids, terms, idf, indptr,
+            np.array(indices, dtype=np.int32), np.array(data, dtype=np.float64)
+        )
+
+    def save(self, path):
+        np.savez(
+            path, doc_ids=np.array(self.doc_ids), terms=np.array(self.terms),
+            idf=np.array([self.idf[term] for term in self.terms]),
+            indptr=self.indptr, indices=self.indices, data=self.data
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            terms = arrays["terms"].tolist()
+            idf = dict(zip(terms, arrays["idf"].tolist()))
+            return cls(
+                arrays["doc_ids"].tolist(), terms, idf,
+                arrays["indptr"], arrays["indices"], arrays["data"]
+            )
+
+    def query_matrix(self, queries):
+        # COO triplets (query row, term id, weight) of the batch, in query_to_vector order
+        rows, columns, weights = [], [], []
+        for row, query in enumerate(queries):
+            for term, weight in indexing.query_to_vector(query, self.idf).items():
+                rows.append(row)
+                columns.append(self.term_ids[term])
+                weights.append(weight)
+        return (
+            np.array(rows, dtype=np.int64),
+            np.array(columns, dtype=np.int64),
+            np.array(weights, dtype=np.float64),
+        )
+
+    def score(self, queries):
+        rows, columns, weights = self.query_matrix(queries)
+        doc_count = len(self.doc_ids)
+
+        # Expand every (query, term) pair into the term's postings
+        starts = self.indptr[columns]
+        lengths = self.indptr[columns + 1] - starts
+        total = int(lengths.sum())
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+        cells = np.repeat(rows, lengths) * doc_count + self.indices[offsets]
+        products = np.repeat(weights, lengths) * self.data[offsets]
+        scores = np.bincount(cells, weights=products, minlength=len(queries) * doc_count)
+        return scores.reshape(len(queries), doc_count)
+
+    def top_k(self, scores, k):
+        results = []
+        for row in scores:
+            candidates = np.flatnonzero(row > 0)
+            if len(candidates) > k:
+                kth = row[candidates[np.argpartition(-row[candidates], k - 1)[:k]]].min()
+                # Keep every tie with the k-th score so the doc id decides like in retrieve_documents
+                candidates = candidates[row[candidates] >= kth]
+            order = np.lexsort((candidates, -row[candidates]))[:k]
+            results.append([self.doc_ids[number] for number in candidates[order]])
+        return results
+
+    def search(self, queries, k=10, batch_size=None):
+        # Dense score blocks are B x N, the batch size keeps each block around 16M cells
+        if batch_size is None:
+            batch_size = max(1, (1 << 24) // max(len(self.doc_ids), 1))
+
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            results.extend(self.top_k(self.score(batch), k))
+        return results
@@ -0,0 +1,296 @@
+﻿import os
+import json
+import gzip
+import time
+import heapq
+import shutil
+import struct
+import argparse
+from array import array
+
+import indexing
+import doc_store
+import binary_index
+import variant_index
+import instrumentation
+
+# term length, document frequency, positions length, max term frequency
+RUN_ENTRY = struct.Struct("<IIII")
+METADATA_FILE = "metadata.jsonl"
+# Rough per-term cost of the in-memory block on top of the term and posting bytes: dict
+# slot, str, list, array and bytearray objects
+TERM_OVERHEAD = 300
+# Runs open at once while merging. Beyond that, groups of runs are first merged into
+# bigger runs, a small budget on a large dump would otherwise run out of file descriptors.
+MAX_MERGE_RUNS = 64
+
+
+def iter_articles(source):
+    # Articles one at a time from a folder of JSON files (in name order, like
+    # build_inverted_index) or from a JSONL dump, optionally gzipped
+    if os.path.isdir(source):
+        for file_name in sorted(name for name in os.listdir(source) if name.endswith(".json")):
+            yield indexing.read_article(os.path.join(source, file_name))
+        return
+
+    opener = gzip.open if source.endswith(".gz") else open
+    with opener(source, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_run_entry(f, term, df, postings, positions, max_tf):
+    encoded_term = term.encode("utf-8")
+    f.write(RUN_ENTRY.pack(len(encoded_term), df, len(positions), max_tf))
+    f.write(encoded_term)
+    f.write(postings)
+    f.write(positions)
+
+
+def read_run(run_path, number):
+    # (term, run number, df, postings bytes, positions bytes, max tf) in term order
+    with open(run_path, "rb") as f:
+        while True:
+            header = f.read(RUN_ENTRY.size)
+            if not header:
+                return
+            term_length, df, positions_length, max_tf = RUN_ENTRY.unpack(header)
+            term = f.read(term_length).decode("utf-8")
+            yield term, number, df, f.read(8 * df), f.read(positions_length), max_tf
+
+
+class StreamingIndexBuilder:
+    # Single-pass in-memory indexing (SPIMI): postings of the current block are kept
+    # encoded in memory and written to a sorted run file whenever the block reaches
+    # memory_budget bytes. finish() merges the runs term by term into a binary index.
+    # Bodies go straight to the document store and metadata to a spill file, so memory
+    # stays bounded by the budget whatever the corpus size, apart from the set of doc ids
+    # that keeps duplicates out.
+
+    def __init__(self, index_dir, memory_budget=256 * 1024 * 1024, compress=True, progress_every=10000):
+        self.index_dir = index_dir
+        self.memory_budget = memory_budget
+        self.progress_every = progress_every
+
+        self.tmp_dir = index_dir + ".tmp"
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        self.runs_dir = os.path.join(self.tmp_dir, "runs")
+        os.makedirs(self.runs_dir)
+
+        self.documents = doc_store.DocumentStoreWriter(self.tmp_dir, compress)
+        self.metadata_out = open(os.path.join(self.runs_dir, METADATA_FILE), "w", encoding="utf-8")
+        self.columns = []
+        # Only the ids themselves grow with the corpus, duplicates in a dump are skipped
+        self.seen = set()
+        self.doc_count = 0
+        self.skipped = 0
+        self.runs = []
+        self.block = {}
+        self.block_size = 0
+        self.started = time.perf_counter()
+
+    def add(self, content):
+        post_id, metadata = indexing.article_metadata(content)
+        if post_id in self.seen:
+            self.skipped += 1
+            return
+        self.seen.add(post_id)
+        number = self.doc_count
+        self.doc_count += 1
+        instrumentation.count("documents_indexed")
+
+        text = metadata.pop("content")
+        self.documents.add(text)
+        self.metadata_out.write(json.dumps([post_id, metadata], ensure_ascii=False) + "\n")
+        for name in metadata:
+            if name not in self.columns:
+                self.columns.append(name)
+
+        term_positions = {}
+        for position, token in enumerate(indexing.tokenize(text)):
+            term_positions.setdefault(token, []).append(position)
+
+        for term, positions in term_positions.items():
+            entry = self.block.get(term)
+            if entry is None:
+                entry = self.block[term] = [array("I"), bytearray(), 0]
+                self.block_size += len(term) + TERM_OVERHEAD
+            encoded = binary_index.encode_positions(positions)
+            entry[0].extend((number, len(positions)))
+            entry[1] += encoded
+            entry[2] = max(entry[2], len(positions))
+            self.block_size += 8 + len(encoded)
+
+        if self.block_size >= self.memory_budget:
+            self.flush()
+        if self.progress_every and self.doc_count % self.progress_every == 0:
+            self.report()
+
+    def add_all(self, articles):
+        for article in articles:
+            self.add(article)
+        return self
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.doc_count / elapsed if elapsed else 0
+        print(f"{self.doc_count} documents, {rate:.0f} docs/sec, {len(self.runs)} runs written")
+
+    def flush(self):
+        # Write the block as a run sorted by term; doc numbers only grow, so runs hold
+        # increasing doc ranges and a term's postings concatenate in run order
+        if not self.block:
+            return
+        with instrumentation.stage("build.flush_run"):
+            self.write_run()
+
+    def write_run(self):
+        run_path = os.path.join(self.runs_dir, f"run-{len(self.runs):05d}.bin")
+        with open(run_path, "wb") as f:
+            for term in sorted(self.block):
+                postings, positions, max_tf = self.block[term]
+                write_run_entry(f, term, len(postings) // 2, binary_index._to_bytes(postings), positions, max_tf)
+        self.runs.append(run_path)
+        self.block = {}
+        self.block_size = 0
+
+    def merge_run_group(self, paths, run_path):
+        # Consecutive runs merged into one run, a term's postings stay in doc number order
+        streams = [read_run(path, number) for number, path in enumerate(paths)]
+        with open(run_path, "wb") as f:
+            # term, df, postings parts, positions parts, max tf
+            entry = None
+            for term, _, df, postings, positions, max_tf in heapq.merge(*streams):
+                if entry is None or entry[0] != term:
+                    if entry is not None:
+                        write_run_entry(f, entry[0], entry[1], b"".join(entry[2]), b"".join(entry[3]), entry[4])
+                    entry = [term, 0, [], [], 0]
+                entry[1] += df
+                entry[2].append(postings)
+                entry[3].append(positions)
+                entry[4] = max(entry[4], max_tf)
+            if entry is not None:
+                write_run_entry(f, entry[0], entry[1], b"".join(entry[2]), b"".join(entry[3]), entry[4])
+        for path in paths:
+            os.remove(path)
+        return run_path
+
+    def merge_runs(self):
+        # External k-way merge of every run into the lexicon, postings and positions files
+        # Equal terms come out in run order, i.e. with increasing doc numbers
+        paths = self.runs
+        merge_pass = 0
+        while len(paths) > MAX_MERGE_RUNS:
+            merge_pass += 1
+            paths = [
+                self.merge_run_group(
+                    paths[i:i + MAX_MERGE_RUNS],
+                    os.path.join(self.runs_dir, f"merge-{merge_pass}-{i // MAX_MERGE_RUNS:05d}.bin")
+                )
+                for i in range(0, len(paths), MAX_MERGE_RUNS)
+            ]
+        streams = [read_run(path, number) for number, path in enumerate(paths)]
+        term_count = 0
+        with open(os.path.join(self.tmp_dir, binary_index.LEXICON_FILE), "wb") as lexicon_out, \
+                open(os.path.join(self.tmp_dir, binary_index.TERMS_FILE), "wb") as terms_out, \
+                open(os.path.join(self.tmp_dir, binary_index.POSTINGS_FILE), "wb") as postings_out, \
+                open(os.path.join(self.tmp_dir, binary_index.POSITIONS_FILE), "wb") as positions_out:
+            # Term count is only known at the end, the header is rewritten then
+            lexicon_out.write(binary_index.HEADER.pack(binary_index.MAGIC, binary_index.VERSION, 0, self.doc_count))
+
+            current = None
+            for term, _, df, postings, positions, max_tf in heapq.merge(*streams):
+                if term != current:
+                    if current is not None:
+                        lexicon_out.write(binary_index.ENTRY.pack(*entry))
+                    current = term
+                    term_count += 1
+                    encoded_term = term.encode("utf-8")
+                    entry = [terms_out.tell(), len(encoded_term), 0, postings_out.tell(), positions_out.tell(), 0]
+                    terms_out.write(encoded_term)
+                entry[2] += df
+                entry[5] = max(entry[5], max_tf)
+                postings_out.write(postings)
+                positions_out.write(positions)
+            if current is not None:
+                lexicon_out.write(binary_index.ENTRY.pack(*entry))
+
+            lexicon_out.seek(0)
+            lexicon_out.write(binary_index.HEADER.pack(binary_index.MAGIC, binary_index.VERSION, term_count, self.doc_count))
+        return term_count
+
+    def write_docs(self):
+        # docs.json is column oriented: the spilled metadata is read once for the ids and
+        # once per column, each array written value by value as it is read, so no column is
+        # ever held in memory. The output is the same as json.dumps of the whole lists.
+        metadata_path = os.path.join(self.runs_dir, METADATA_FILE)
+
+        def read_metadata():
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+        def write_array(f, values):
+            f.write("[")
+            for number, value in enumerate(values):
+                f.write((", " if number else "") + json.dumps(value, ensure_ascii=False))
+            f.write("]")
+
+        with open(os.path.join(self.tmp_dir, binary_index.DOCS_FILE), "w", encoding="utf-8") as f:
+            f.write('{"doc_ids": ')
+            write_array(f, (post_id for post_id, _ in read_metadata()))
+            f.write(', "columns": {')
+            for number, name in enumerate(self.columns):
+                f.write((", " if number else "") + json.dumps(name, ensure_ascii=False) + ": ")
+                write_array(f, (metadata.get(name) for _, metadata in read_metadata()))
+            f.write("}}")
+
+    def finish(self):
+        self.flush()
+        self.documents.close()
+        self.metadata_out.close()
+        merge_started = time.perf_counter()
+        with instrumentation.stage("build.merge_runs"):
+            term_count = self.merge_runs()
+        with instrumentation.stage("build.write_docs"):
+            self.write_docs()
+        with instrumentation.stage("build.variants"):
+            lexicon = binary_index.PostingsDictionary(self.tmp_dir, [])
+            variant_index.write_variant_index(self.tmp_dir, lexicon.document_frequencies())
+            # The lexicon files are memory-mapped, they have to be closed before the rename
+            del lexicon
+        merge_time = time.perf_counter() - merge_started
+
+        shutil.rmtree(self.runs_dir)
+        if os.path.exists(self.index_dir):
+            shutil.rmtree(self.index_dir)
+        os.replace(self.tmp_dir, self.index_dir)
+
+        elapsed = time.perf_counter() - self.started
+        print(f"Indexed {self.doc_count} documents ({term_count} terms) from {len(self.runs)} runs "
+              f"in {elapsed:.1f} s, {self.doc_count / elapsed if elapsed else 0:.0f} docs/sec "
+              f"(merge {merge_time:.1f} s).")
+        if self.skipped:
+            print(f"Skipped {self.skipped} articles with a duplicate post_id.")
+        return self.doc_count
+
+
+def build_streaming_index(source, index_dir, memory_budget=256 * 1024 * 1024, compress=True, progress_every=10000):
+    builder = StreamingIndexBuilder(index_dir, memory_budget, compress, progress_every)
+    return builder.add_all(iter_articles(source)).finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a binary index with bounded memory.")
+    parser.add_argument("source", help="folder of article JSON files or a JSONL dump (.jsonl or .jsonl.gz)")
+    parser.add_argument("index_dir")
+    parser.add_argument("--memory-mb", type=int, default=256, help="postings kept in memory before a run is flushed")
+    parser.add_argument("--progress-every", type=int, default=10000)
+    parser.add_argument("--no-compress", action="store_true", help="store article bodies uncompressed")
+    args = parser.parse_args()
+
+    build_streaming_index(
+        args.source, args.index_dir, args.memory_mb * 1024 * 1024, not args.no_compress, args.progress_every
+    )
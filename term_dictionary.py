@@ -0,0 +1,123 @@
+﻿import re
+import heapq
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+WILDCARDS = "*?"
+# A '?' ending a word closes a question, "kết?" is not a pattern
+TRAILING_QUESTION = re.compile(r"\?[^\w*]*$")
+# Most frequent terms a wildcard query term expands to, bounds the cost of "a*"
+MAX_EXPANSIONS = 64
+
+
+class Column(Sequence):
+    # Read-only sequence over item(i), lets bisect run on the lexicon of a binary index
+
+    __slots__ = ("item", "length")
+
+    def __init__(self, item, length):
+        self.item = item
+        self.length = length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return self.item(i)
+
+    def __len__(self):
+        return self.length
+
+
+def has_wildcard(word):
+    word = TRAILING_QUESTION.sub("", word)
+    return any(char in word for char in WILDCARDS)
+
+
+def literal_prefix(pattern):
+    # Part of a wildcard pattern before its first wildcard
+    return re.split(r"[*?]", pattern, 1)[0]
+
+
+def pattern_regex(pattern):
+    # '*' any run of characters, '?' exactly one
+    return re.compile("".join(
+        ".*" if char == "*" else "." if char == "?" else re.escape(char) for char in pattern
+    ))
+
+
+class TermDictionary:
+    # Sorted vocabulary of an index with each term's document frequency. All prefix
+    # lookups are a binary search for the range of terms sharing the prefix, the rest of
+    # the vocabulary is never looked at.
+
+    def __init__(self, terms, document_frequencies):
+        self.terms = terms
+        self.document_frequencies = document_frequencies
+
+    @classmethod
+    def from_frequencies(cls, doc_frequencies):
+        terms = sorted(doc_frequencies)
+        return cls(terms, array("I", [doc_frequencies[term] for term in terms]))
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        # The lexicon of a binary index is already sorted and is searched in place
+        if hasattr(tokens, "term_at"):
+            return cls(Column(tokens.term_at, len(tokens)), Column(tokens.document_frequency_at, len(tokens)))
+        if hasattr(tokens, "document_frequencies"):
+            return cls.from_frequencies(dict(tokens.document_frequencies()))
+        return cls.from_frequencies({term: len(docs) for term, docs in tokens.items()})
+
+    def __len__(self):
+        return len(self.terms)
+
+    def prefix_range(self, prefix):
+        # [low, high) of the terms starting with prefix, in code point order like sorted()
+        low = bisect_left(self.terms, prefix)
+        if not prefix:
+            return low, len(self.terms)
+        following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return low, bisect_left(self.terms, following, low)
+
+    def terms_with_prefix(self, prefix):
+        low, high = self.prefix_range(prefix)
+        for number in range(low, high):
+            yield number, self.terms[number]
+
+    def complete(self, prefix, limit=10):
+        # Most frequent terms starting with prefix, ties in alphabetical order
+        if not prefix:
+            return []
+        frequencies = self.document_frequencies
+        ranked = heapq.nsmallest(
+            limit, self.terms_with_prefix(prefix), key=lambda x: (-frequencies[x[0]], x[1])
+        )
+        return [term for _, term in ranked]
+
+    def expand(self, pattern, limit=MAX_EXPANSIONS):
+        # Terms matching a wildcard pattern such as "bóng*" or "b?ng", most frequent first,
+        # all of them for limit=None. Patterns have to start with a literal prefix, "*ng"
+        # would need the whole vocabulary.
+        prefix = literal_prefix(pattern)
+        if not prefix:
+            return []
+        matches = self.terms_with_prefix(prefix)
+        if pattern != prefix + "*":
+            regex = pattern_regex(pattern)
+            matches = ((number, term) for number, term in matches if regex.fullmatch(term))
+        frequencies = self.document_frequencies
+        key = lambda x: (-frequencies[x[0]], x[1])
+        ranked = sorted(matches, key=key) if limit is None else heapq.nsmallest(limit, matches, key=key)
+        return [term for _, term in ranked]
+
+
+_dictionary = None
+
+
+def get_term_dictionary(index):
+    # Built once per index, like boolean_query.get_evaluator
+    global _dictionary
+    if _dictionary is None or _dictionary[0] is not index["tokens"]:
+        _dictionary = (index["tokens"], TermDictionary.from_tokens(index["tokens"]))
+    return _dictionary[1]
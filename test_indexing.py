@@ -0,0 +1,34 @@
+﻿from collections import defaultdict
+
+import indexing
+
+
+def make_engine(texts):
+    inverted_index = {"tokens": defaultdict(dict), "metadata": {}}
+    for number, text in enumerate(texts):
+        indexing.add_article(inverted_index, {"post_id": str(number), "content": text})
+    inverted_index["tokens"] = dict(inverted_index["tokens"])
+    return indexing.SearchIndex.from_inverted_index(inverted_index)
+
+
+def test_parse_phrase_query():
+    assert indexing.parse_phrase_query('"việt nam"') == ("việt nam", 0)
+    assert indexing.parse_phrase_query('"việt nam"~2') == ("việt nam", 2)
+    assert indexing.parse_phrase_query('"huấn luyện" AND "việt nam"') is None
+
+
+def test_trailing_question_mark_is_not_a_wildcard():
+    assert indexing.split_wildcards("vào chung kết?") == indexing.split_wildcards("vào chung kết")
+    assert indexing.split_wildcards("b?ng kết?") == (["kết"], ["b?ng"])
+
+
+def test_two_quoted_phrases_are_a_boolean_query():
+    query = '"huấn luyện" AND "việt nam"'
+    engine = make_engine([
+        "đội tuyển việt nam có huấn luyện viên mới",
+        "huấn luyện viên nói về việt nam",
+        "việt nam vào chung kết",
+    ])
+    assert indexing.query_mode(query) == "boolean"
+    assert engine.cached_search(query) == ["0", "1"]
+    assert engine.cached_search(query) == engine.cached_search(query, mode="boolean")
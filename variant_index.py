@@ -0,0 +1,235 @@
+﻿import os
+import sys
+import json
+import zlib
+import struct
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+import compact_index
+
+# Written next to a binary index: accent-folded forms with their terms, and the SymSpell
+# deletion table over the forms
+FORMS_FILE = "variant_forms.json"
+DELETES_FILE = "variant_deletes.bin"
+MAGIC = b"SEVD"
+VERSION = 1
+# magic, format version, deletion count, max edit distance, prefix length
+HEADER = struct.Struct("<4sIIII")
+
+MAX_DISTANCE = 2
+# Only deletions of the first PREFIX_LENGTH characters are indexed, which bounds the
+# neighbourhood of long terms to a few dozen entries; candidates are verified on the whole form
+PREFIX_LENGTH = 7
+# Weight of a variant against the exact term (1.0): same word without diacritics, then one
+# and two typos away
+FOLDED_WEIGHT = 0.8
+DISTANCE_WEIGHTS = {1: 0.5, 2: 0.25}
+# Variants a query word expands to at most, most frequent first
+MAX_VARIANTS = 8
+
+
+def fold(term):
+    # "bóng đá" -> "bong da": tone marks and other diacritics dropped, đ written as d
+    decomposed = unicodedata.normalize("NFD", term.replace("đ", "d").replace("Đ", "D"))
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def typo_distance(form):
+    # Edits tolerated for a word of this length, short words are too close to other words
+    if len(form) < 4:
+        return 0
+    return 1 if len(form) < 7 else 2
+
+
+def deletes(word, max_distance):
+    # Every string left after deleting up to max_distance characters of word
+    result = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {text[:i] + text[i + 1:] for text in frontier for i in range(len(text))}
+        result |= frontier
+    return result
+
+
+def delete_hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def edit_distance(first, second, max_distance):
+    # Optimal string alignment distance (an adjacent transposition is one edit), None when
+    # it is larger than max_distance
+    if abs(len(first) - len(second)) > max_distance:
+        return None
+    before_previous = None
+    previous = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        current = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], before_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return None
+        before_previous, previous = previous, current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+def build_forms(doc_frequencies):
+    # (sorted folded forms, the terms of each form, most frequent first)
+    groups = defaultdict(list)
+    for term, df in doc_frequencies:
+        groups[fold(term)].append((-df, term))
+    forms = sorted(groups)
+    return forms, [[term for _, term in sorted(groups[form])] for form in forms]
+
+
+def build_deletes(forms):
+    # (hash of a deletion, form number) pairs sorted by hash, as two parallel arrays.
+    # Hash collisions only add candidates, which are verified anyway.
+    keys = set()
+    for number, form in enumerate(forms):
+        for text in deletes(form[:PREFIX_LENGTH], MAX_DISTANCE):
+            keys.add(delete_hash(text) << 32 | number)
+    keys = sorted(keys)
+    return array("I", [key >> 32 for key in keys]), array("I", [key & 0xFFFFFFFF for key in keys])
+
+
+def write_variant_index(index_dir, doc_frequencies):
+    # Called at index time with the (term, df) pairs of the index
+    forms, form_terms = build_forms(doc_frequencies)
+    hashes, numbers = build_deletes(forms)
+
+    with open(os.path.join(index_dir, FORMS_FILE), "w", encoding="utf-8") as f:
+        json.dump({"forms": forms, "terms": form_terms}, f, ensure_ascii=False)
+    with open(os.path.join(index_dir, DELETES_FILE), "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(hashes), MAX_DISTANCE, PREFIX_LENGTH))
+        for values in (hashes, numbers):
+            if sys.byteorder != "little":
+                values = array("I", values)
+                values.byteswap()
+            f.write(values.tobytes())
+
+
+def expand_word(word, variants):
+    # (term, weight) pairs searched for a query word, just the word itself without variants
+    if variants is None:
+        return [(word, 1.0)]
+    expansions = variants(word)
+    return [(word, 1.0)] if expansions is None else expansions
+
+
+def variant_postings(tokens, expansions):
+    # Postings of any of the expanded terms as one posting list, with merged positions
+    posting_lists = [docs for docs in (tokens.get(term, {}) for term, _ in expansions) if docs]
+    if len(posting_lists) < 2:
+        return posting_lists[0] if posting_lists else {}
+    if all(hasattr(docs, "doc_numbers") and docs.table is posting_lists[0].table for docs in posting_lists):
+        return compact_index.merge_posting_lists(posting_lists)
+    merged = {}
+    for docs in posting_lists:
+        for doc_id, positions in docs.items():
+            merged[doc_id] = sorted(list(merged.get(doc_id, [])) + list(positions))
+    return merged
+
+
+def weighted_terms(tokens, variants):
+    # {term: (query occurrences, best weight)} for the query tokens, each token replaced by
+    # its variants; without variants every token is its own term with weight 1
+    terms = {}
+    for token in tokens:
+        for term, weight in expand_word(token, variants):
+            count, best = terms.get(term, (0, 0))
+            terms[term] = (count + 1, max(best, weight))
+    return terms
+
+
+class VariantIndex:
+    # Spelling variants of query words, looked up instead of scanned: terms sharing the
+    # word's accent-folded form come from one dict, typo candidates from the symmetric
+    # deletion (SymSpell) table, where a word and a term within distance d share a
+    # deletion of at most d characters.
+
+    def __init__(self, forms, form_terms, hashes, numbers, contains):
+        self.forms = forms
+        self.form_terms = form_terms
+        self.form_numbers = {form: number for number, form in enumerate(forms)}
+        self.hashes = hashes
+        self.numbers = numbers
+        self.contains = contains
+
+    @classmethod
+    def open(cls, index_dir, tokens):
+        # Tables stored next to a binary index, written on first use for older indexes
+        if not os.path.exists(os.path.join(index_dir, DELETES_FILE)):
+            print(f"Building spelling variants for '{index_dir}'...")
+            write_variant_index(index_dir, tokens.document_frequencies())
+
+        with open(os.path.join(index_dir, FORMS_FILE), "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        with open(os.path.join(index_dir, DELETES_FILE), "rb") as f:
+            magic, version, count, max_distance, prefix_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION or (max_distance, prefix_length) != (MAX_DISTANCE, PREFIX_LENGTH):
+                raise ValueError(f"'{index_dir}' has no valid spelling variant table")
+            hashes = array("I")
+            hashes.frombytes(f.read(4 * count))
+            numbers = array("I")
+            numbers.frombytes(f.read(4 * count))
+        if sys.byteorder != "little":
+            hashes.byteswap()
+            numbers.byteswap()
+        return cls(stored["forms"], stored["terms"], hashes, numbers, tokens.__contains__)
+
+    @classmethod
+    def from_frequencies(cls, doc_frequencies):
+        # In memory, for indexes without files and for the shard coordinator
+        forms, form_terms = build_forms(doc_frequencies.items())
+        return cls(forms, form_terms, *build_deletes(forms), doc_frequencies.__contains__)
+
+    def corrections(self, form):
+        # (term, distance) of the terms closest to form within its typo distance
+        max_distance = typo_distance(form)
+        if not max_distance:
+            return []
+        best = {}
+        for text in deletes(form[:PREFIX_LENGTH], max_distance):
+            key = delete_hash(text)
+            i = bisect_left(self.hashes, key)
+            while i < len(self.hashes) and self.hashes[i] == key:
+                number = self.numbers[i]
+                i += 1
+                if number not in best:
+                    best[number] = edit_distance(form, self.forms[number], max_distance)
+        distances = [distance for distance in best.values() if distance]
+        if not distances:
+            return []
+        # Only the nearest forms, a term one typo away hides those two typos away
+        closest = min(distances)
+        numbers = sorted(number for number, distance in best.items() if distance == closest)
+        return [(term, closest) for number in numbers for term in self.form_terms[number]]
+
+    def __call__(self, word):
+        return self.expand(word)
+
+    def expand(self, word):
+        # [(term, weight)] searched for a query word: the word itself when the index has it,
+        # then the terms written the same without diacritics when the word has none, so
+        # "bong da" also finds "bóng đá". A word typed with diacritics is only searched as
+        # written. Typo corrections are only tried for words the index does not have.
+        expansions = {}
+        if self.contains(word):
+            expansions[word] = 1.0
+        form = fold(word)
+        if form == word or not expansions:
+            number = self.form_numbers.get(form)
+            if number is not None:
+                for term in self.form_terms[number][:MAX_VARIANTS]:
+                    expansions.setdefault(term, FOLDED_WEIGHT)
+        if not expansions:
+            for term, distance in self.corrections(form)[:MAX_VARIANTS]:
+                expansions.setdefault(term, DISTANCE_WEIGHTS[distance])
+        return list(expansions.items())
+